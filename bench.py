@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+'''
+Microbenchmarks for the BLSTHS primitives in bls.py.
+
+Every operation is timed on its own, one call at a time, after a few
+untimed warmup calls, and summarized with the same histograms as the run
+statistics (mean, min, max and percentiles). Inputs are prepared outside
+the timed call, and every call gets a fresh message so the hash cache never
+hides the cost of hashing to the curve. Operations that depend on the
+number of shares or the threshold are swept over every (n, t) pair with
+t <= n. Run as
+
+    ./bench.py [--curve C] [--repeats R] [--warmup W] [--counts N ...]
+               [--thresholds T ...] [--only OP ...] [--json FILE]
+    ./bench.py --curves [C ...] [--repeats R] [--json FILE]
+    ./bench.py --compare OLD.json NEW.json [--tolerance F]
+
+--curves times signing, aggregation and verification on each curve the
+backend has (all that the wire format knows by default), along with the
+size of a signature share and a key share, to pick a curve by. --compare
+lines up the measurements of two saved runs and flags those whose median
+moved by more than the tolerance and out of the other run's p10 to p90
+range.
+'''
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+import stats
+import wire
+
+WARMUP = 3  # untimed calls before each measurement
+REPEATS = 50  # timed calls per measurement
+COUNTS = [10, 50, 100]  # n for the operations that depend on it
+THRESHOLDS = [2, 7, 25, 50]  # t for the operations that depend on it
+FIXED = (10, 7)  # (n, t) for the operations that depend on neither
+TOLERANCE = .05  # relative change of the median that --compare reports
+SEED = 0  # signer sets are random, but the same from run to run
+# timings are recorded in nanoseconds, since a microsecond step would be a
+# large part of the fastest operations
+UNIT = 1e-9
+
+
+class Bench:
+    # one group and scheme for the whole run, with keys made on demand
+    def __init__(self, curve=None):
+        # charm is only needed for timing, not for comparing saved runs
+        from bls import BLSTHS, PairingGroup, CURVE
+        self.curve = curve or CURVE
+        self.go = PairingGroup(self.curve)
+        self.bls = BLSTHS(self.go)
+        self.keys = {}
+        self.rng = random.Random(SEED)
+        self.count = 0
+
+    def key(self, n, t):
+        if (n, t) not in self.keys:
+            self.keys[(n, t)] = self.bls.keygen(n, t)
+        return self.keys[(n, t)]
+
+    def message(self):
+        self.count += 1
+        return b"bench message %d" % self.count
+
+    def partials(self, n, t):
+        # shares of a fresh message from a random set of t signers
+        (_, shares) = self.key(n, t)
+        m = self.message()
+        signers = self.rng.sample(range(1, n+1), t)
+        return (m, [(i, self.bls.sign(shares[i-1], m)) for i in signers])
+
+    def signature(self, n, t):
+        (m, partials) = self.partials(n, t)
+        return (m, self.bls.aggregate(partials))
+
+
+# each operation prepares the function and arguments for one timed call
+def prepare_keygen(b, n, t):
+    return (b.bls.keygen, (n, t))
+
+
+def prepare_gen_shares(b, n, t):
+    (pk, _) = b.key(n, t)
+    return (b.bls.gen_shares, (n, t, pk['g'], b.go.random()))
+
+
+def prepare_sign(b, n, t):
+    (_, shares) = b.key(n, t)
+    return (b.bls.sign, (shares[0], b.message()))
+
+
+def prepare_aggregate(b, n, t):
+    return (b.bls.aggregate, (b.partials(n, t)[1], "naive"))
+
+
+def prepare_aggregate_straus(b, n, t):
+    return (b.bls.aggregate, (b.partials(n, t)[1], "straus"))
+
+
+def prepare_verify(b, n, t):
+    (pk, _) = b.key(n, t)
+    (m, sig) = b.signature(n, t)
+    return (b.bls.verify, (pk, sig, m))
+
+
+def prepare_serialize(b, n, t):
+    return (b.go.serialize, (b.signature(n, t)[1],))
+
+
+def prepare_deserialize(b, n, t):
+    return (b.go.deserialize, (b.go.serialize(b.signature(n, t)[1]),))
+
+
+def prepare_dump(b, n, t):
+    return (b.bls.dump, (b.signature(n, t)[1],))
+
+
+# name -> (swept over n and t, prepare)
+OPERATIONS = {
+    'keygen': (True, prepare_keygen),
+    'gen_shares': (True, prepare_gen_shares),
+    'sign': (False, prepare_sign),
+    'aggregate': (True, prepare_aggregate),
+    'aggregate_straus': (True, prepare_aggregate_straus),
+    'verify': (False, prepare_verify),
+    'serialize': (False, prepare_serialize),
+    'deserialize': (False, prepare_deserialize),
+    'dump': (False, prepare_dump),
+}
+
+
+def measure(b, prepare, n, t, warmup, repeats):
+    hist = stats.Histogram(UNIT)
+    for i in range(warmup + repeats):
+        (fn, args) = prepare(b, n, t)
+        start = time.perf_counter_ns()
+        fn(*args)
+        elapsed = time.perf_counter_ns() - start
+        if i >= warmup:
+            hist.record(elapsed*UNIT)
+    out = hist.summary()
+    out['p10'] = round(hist.percentile(10), hist.digits)
+    return out
+
+
+def run(curve, ops, counts, thresholds, warmup, repeats):
+    b = Bench(curve)
+    pairs = [(n, t) for n in counts for t in thresholds if t <= n]
+    results = []
+    for op in ops:
+        (swept, prepare) = OPERATIONS[op]
+        for (n, t) in (pairs if swept else [FIXED]):
+            summary = measure(b, prepare, n, t, warmup, repeats)
+            result = dict(op=op, n=n if swept else None,
+                          t=t if swept else None, **summary)
+            results.append(result)
+            show(result)
+    return {
+        'curve': b.curve,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'warmup': warmup,
+        'repeats': repeats,
+        'results': results,
+    }
+
+
+def compare_curves(curves, warmup, repeats):
+    # sign, aggregate and verify throughput at FIXED, and share sizes on
+    # the wire, for every curve that the backend can set up
+    (n, t) = FIXED
+    results = []
+    print(f"{'curve':<8} {'sign/sec':>10} {'aggregate/sec':>14} "
+          f"{'verify/sec':>11} {'share B':>8} {'key B':>6}")
+    for curve in curves:
+        try:
+            b = Bench(curve)
+            (_, shares) = b.key(n, t)
+        except Exception as e:  # charm raises all sorts for these
+            print(f"{curve:<8} unavailable: {e}")
+            continue
+        result = {'curve': curve}
+        for op in ("sign", "aggregate", "verify"):
+            summary = measure(b, OPERATIONS[op][1], n, t, warmup, repeats)
+            result[op] = summary
+            result[op + '_per_second'] = 1/summary['mean']
+        result['share_bytes'] = len(
+            wire.pack_point(b.go, b.signature(n, t)[1]))
+        result['key_bytes'] = len(wire.pack_point(b.go, shares[0]))
+        results.append(result)
+        print(f"{curve:<8} {result['sign_per_second']:>10.1f} "
+              f"{result['aggregate_per_second']:>14.1f} "
+              f"{result['verify_per_second']:>11.1f} "
+              f"{result['share_bytes']:>8} {result['key_bytes']:>6}")
+        sys.stdout.flush()
+    return {
+        'curves': results,
+        'n': n,
+        't': t,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.time(),
+        'warmup': warmup,
+        'repeats': repeats,
+    }
+
+
+def label(r):
+    if r['n'] is None:
+        return r['op']
+    return f"{r['op']} n={r['n']} t={r['t']}"
+
+
+def show(r):
+    print(f"{label(r):<28} p50 {1e6*r['p50']:11.2f} us  "
+          f"p90 {1e6*r['p90']:11.2f} us  p99 {1e6*r['p99']:11.2f} us  "
+          f"{1/r['mean']:10.1f} ops/sec")
+    sys.stdout.flush()
+
+
+def compare(old, new, tolerance):
+    # returns how many measurements got slower
+    print(f"old: {old['curve']}, python {old['python']}, "
+          f"{old['repeats']} repeats")
+    print(f"new: {new['curve']}, python {new['python']}, "
+          f"{new['repeats']} repeats")
+    before = {(r['op'], r['n'], r['t']): r for r in old['results']}
+    slower = 0
+    for r in new['results']:
+        o = before.get((r['op'], r['n'], r['t']))
+        if o is None:
+            continue
+        change = r['p50']/o['p50'] - 1
+        # a shift inside the noise of either run isn't a change
+        if abs(change) <= tolerance:
+            verdict = ""
+        elif change > 0 and r['p50'] > o['p90'] and o['p50'] < r['p10']:
+            verdict = "slower"
+            slower += 1
+        elif change < 0 and r['p50'] < o['p10'] and o['p50'] > r['p90']:
+            verdict = "faster"
+        else:
+            verdict = "noisy"
+        print(f"{label(r):<28} {1e6*o['p50']:11.2f} -> "
+              f"{1e6*r['p50']:11.2f} us  {100*change:+7.1f}%  {verdict}")
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="time the BLSTHS primitives one by one")
+    parser.add_argument(
+        "--curve", help="pairing curve to time, CURVE or MNT224 by default")
+    parser.add_argument(
+        "--curves", nargs="*", metavar="C",
+        help="compare curves instead: " + ", ".join(wire.CURVES))
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--counts", type=int, nargs="+", default=COUNTS)
+    parser.add_argument(
+        "--thresholds", type=int, nargs="+", default=THRESHOLDS)
+    parser.add_argument(
+        "--only", nargs="+", choices=list(OPERATIONS),
+        default=list(OPERATIONS), metavar="OP",
+        help="operations to time: " + ", ".join(OPERATIONS))
+    parser.add_argument("--json", help="save the results here")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"),
+        help="compare two saved runs instead of timing anything")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    if args.compare:
+        runs = []
+        for path in args.compare:
+            with open(path) as f:
+                runs.append(json.load(f))
+        exit(1 if compare(runs[0], runs[1], args.tolerance) else 0)
+
+    if args.curves is not None:
+        record = compare_curves(
+            args.curves or list(wire.CURVES), args.warmup, args.repeats)
+    else:
+        record = run(args.curve, args.only, args.counts,
+                     args.thresholds, args.warmup, args.repeats)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(record, f, indent=2)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+'''
+Loopback packets-per-second benchmark for the netio backends.
+
+Sender processes blast fixed-size datagrams at a receiver on 127.0.0.1, and
+the receiver counts what it gets through each backend and event loop that
+is available. Run as
+
+    ./bench_io.py [seconds] [payload bytes] [senders] [--json]
+'''
+import asyncio
+import json
+import multiprocessing
+import socket
+import sys
+import time
+
+import netio
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+        self.wakeups = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.count += 1
+        self.wakeups += 1
+
+
+class BurstCounter(Counter):
+    def datagrams_received(self, burst):
+        self.count += len(burst)
+        self.wakeups += 1
+
+
+def blast(addr, size, duration):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = b'\0'*size
+    end = time.time() + duration
+    while time.time() < end:
+        for _ in range(64):
+            try:
+                sock.sendto(payload, addr)
+            except OSError:
+                pass  # ENOBUFS when the receiver falls behind
+    sock.close()
+
+
+def run(backend, loop_kind, duration, size, senders):
+    loop = netio.new_event_loop(loop_kind)
+    asyncio.set_event_loop(loop)
+    factory = BurstCounter if backend == "drain" else Counter
+    (transport, counter) = loop.run_until_complete(netio.create_endpoint(
+        loop, factory, local_addr=("127.0.0.1", 0), backend=backend))
+    addr = transport.get_extra_info("sockname")
+
+    procs = [
+        multiprocessing.Process(target=blast, args=(addr, size, duration))
+        for _ in range(senders)]
+    for p in procs:
+        p.start()
+    loop.run_until_complete(asyncio.sleep(duration))
+    (count, wakeups) = (counter.count, counter.wakeups)
+    for p in procs:
+        p.join()
+    transport.close()
+    loop.close()
+    return {
+        'backend': backend,
+        'loop': loop_kind,
+        'packets_per_second': count/duration,
+        'packets_per_wakeup': count/max(1, wakeups),
+    }
+
+
+def available_loops():
+    loops = ["asyncio"]
+    try:
+        import uvloop  # noqa: F401
+        loops.append("uvloop")
+    except ImportError:
+        pass
+    return loops
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    duration = float(args[0]) if len(args) > 0 else 3
+    size = int(args[1]) if len(args) > 1 else 64
+    senders = int(args[2]) if len(args) > 2 else 2
+
+    results = []
+    for loop_kind in available_loops():
+        for backend in ["asyncio", "drain"]:
+            results.append(run(backend, loop_kind, duration, size, senders))
+
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{size} byte datagrams, {senders} senders, {duration}s each")
+        for r in results:
+            print(f"{r['backend']:>8} on {r['loop']:<8} "
+                  f"{r['packets_per_second']:>12.0f} packets/sec "
+                  f"{r['packets_per_wakeup']:>8.1f} per wakeup")
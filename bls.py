@@ -12,91 +12,292 @@
 :Authors:    J. Ayo Akinyele
 :Date:       1/2011
  '''
-from charm.toolbox.pairinggroup import PairingGroup, ZR, G1, G2, pair
+from charm.toolbox.pairinggroup import PairingGroup, ZR, G1, G2, GT, pair
 from charm.core.engine.util import objectToBytes
 from charm.toolbox.IBSig import IBSig
 
+from collections import OrderedDict
+
+import hashlib
+import multiprocessing
+import os
+import secrets
 import sys
 import time
 
 debug = False
 
+# pairing group the keys are made on; charm also has "SS512", "SS1024",
+# "MNT159", "MNT201" and "BN254"
+CURVE = os.environ.get("CURVE", "MNT224")
+LAGRANGE_CACHE_SIZE = 128  # signer sets whose coefficients are kept
+AGGREGATE_METHOD = "naive"  # "naive" or "straus" (interleaved multi-exp)
+STRAUS_WINDOW = 4  # bits per window in the interleaved multi-exp
+HASH_CACHE_SIZE = 1024  # hashed messages kept as G1 points
+BATCH_VERIFY_BITS = 64  # size of the random exponents in verify_batch
+KEYGEN_PARALLEL_MIN = 512  # fewer shares than this aren't worth a pool
+
+
+def horner(coeffs, points, q):
+    # evaluate the polynomial at every point with plain ints mod q
+    values = []
+    for x in points:
+        acc = 0
+        for c in reversed(coeffs):
+            acc = (acc*x + c) % q
+        values.append(acc)
+    return values
+
 
 class BLSTHS(IBSig):
     def __init__(self, groupObj):
         IBSig.__init__(self)
         global group
         group = groupObj
+        self.lagrange_cache = OrderedDict()
+        self.aggregate_method = AGGREGATE_METHOD
+        self.hash_cache = OrderedDict()
+        self.hash_hits = 0
+        self.hash_misses = 0
+        self.pk_tables = {}
 
     def dump(self, obj):
         return objectToBytes(obj, group)
 
     def poly_eval(self, coeffs, point):
-        eval = coeffs[0]
-        deg = len(coeffs)-1
-
-        temp = point
-        for i in range(1, deg+1):
-            eval = eval + temp*coeffs[i]
-            temp = temp*point
+        # Horner's rule: one multiply and one add per coefficient
+        eval = coeffs[-1]
+        for c in reversed(coeffs[:-1]):
+            eval = eval*point + c
         return eval
 
-    def gen_shares(self, N, t, g, secret):
-        coeffs = [None]*(t+1)
+    def gen_shares(self, N, t, g, secret, workers=1):
+        # degree t-1, so any t shares reconstruct the secret
+        coeffs = [None]*t
         coeffs[0] = secret
-        for i in range(t):
+        for i in range(t-1):
             coeffs[i+1] = group.random(ZR)
 
-        shares = [None]*N
-        for i in range(N):
-            shares[i] = self.poly_eval(coeffs, group.init(ZR, i+1))
+        # evaluate on ints and only build one group element per share
+        q = group.order()
+        ints = [int(c) for c in coeffs]
+        if workers > 1 and N >= KEYGEN_PARALLEL_MIN:
+            chunk = -(-N // workers)
+            jobs = [
+                (ints, range(lo+1, min(lo+chunk, N)+1), q)
+                for lo in range(0, N, chunk)]
+            with multiprocessing.Pool(workers) as pool:
+                values = [v for part in pool.starmap(horner, jobs)
+                          for v in part]
+        else:
+            values = horner(ints, range(1, N+1), q)
 
-        return shares
+        return [group.init(ZR, v) for v in values]
 
-    def keygen(self, N, t, secparam=None):
+    def keygen(self, N, t, secparam=None, workers=1):
         g, x = group.random(G2), group.random()
         g_x = g ** x
         pk = {'g^x': g_x, 'g': g, 'identity': str(g_x), 'secparam': secparam}
-        shares = self.gen_shares(N, t, g, x)
+        shares = self.gen_shares(N, t, g, x, workers)
+        # per-index verification keys g^{x_i}, for checking single shares;
+        # g is the base every time, so precompute its powers first
+        g.initPP()
+        pk['g^x_i'] = [g ** share for share in shares]
         return (pk, shares)
 
-    def sign(self, sk, message):
-        M = self.dump(message)
+    def hash_message(self, message):
+        # bytes are keyed directly so a cache hit skips dump() entirely
+        if isinstance(message, bytes):
+            key = hashlib.sha256(b'b' + message).digest()
+        else:
+            key = hashlib.sha256(b'o' + self.dump(message)).digest()
+        h = self.hash_cache.get(key)
+        if h is not None:
+            self.hash_hits += 1
+            self.hash_cache.move_to_end(key)
+            return h
+
+        self.hash_misses += 1
+        # bytes are hashed as they are; anything else is serialized first
+        M = message if isinstance(message, bytes) else self.dump(message)
         if debug:
             print("Message => '%s'" % M)
-        return group.hash(M, G1) ** sk
+        h = group.hash(M, G1)
+        self.hash_cache[key] = h
+        if len(self.hash_cache) > HASH_CACHE_SIZE:
+            self.hash_cache.popitem(last=False)
+        return h
+
+    def hash_stats(self):
+        return {
+            'hits': self.hash_hits,
+            'misses': self.hash_misses,
+            'size': len(self.hash_cache),
+        }
+
+    def sign(self, sk, message):
+        return self.hash_message(message) ** sk
+
+    def pk_table(self, pk):
+        # fixed G2 side of the verification equation, inverted once per key
+        # so e(sig, g) == e(h, g^x) becomes e(sig, g) * e(h, g^-x) == 1
+        table = self.pk_tables.get(pk['identity'])
+        if table is None:
+            minus_one = -group.init(ZR, 1)
+            table = ([pk['g'], pk['g^x'] ** minus_one], group.init(GT, 1))
+            self.pk_tables[pk['identity']] = table
+        return table
 
     def verify(self, pk, sig, message):
-        M = self.dump(message)
-        h = group.hash(M, G1)
-        if pair(sig, pk['g']) == pair(h, pk['g^x']):
+        (rhs, one) = self.pk_table(pk)
+        h = self.hash_message(message)
+        # one multi-pairing shares the final exponentiation
+        return pair([sig, h], rhs) == one
+
+    def verify_batch(self, pk, items):
+        # items is a list of (sig, message); a random linear combination
+        # checks all of them with a single two-term multi-pairing
+        if not items:
             return True
-        return False
+        (rhs, one) = self.pk_table(pk)
+        sig_acc = group.init(G1, 1)
+        weights = OrderedDict()  # message -> summed exponents
+        for (sig, message) in items:
+            r = group.init(ZR, secrets.randbits(BATCH_VERIFY_BITS) | 1)
+            sig_acc = sig_acc*(sig**r)
+            if message in weights:
+                weights[message] = weights[message] + r
+            else:
+                weights[message] = r
+        h_acc = group.init(G1, 1)
+        for (message, r) in weights.items():
+            h_acc = h_acc*(self.hash_message(message)**r)
+        return pair([sig_acc, h_acc], rhs) == one
+
+    def lagrange_coeffs(self, indices):
+        # coefficients at zero for this signer set, keyed by sorted indices
+        key = tuple(sorted(indices))
+        coeffs = self.lagrange_cache.get(key)
+        if coeffs is not None:
+            self.lagrange_cache.move_to_end(key)
+            return coeffs
+
+        points = [group.init(ZR, idx) for idx in key]
+        nums = []
+        dens = []
+        for i, xi in enumerate(points):
+            num = group.init(ZR, 1)
+            den = group.init(ZR, 1)
+            for j, xj in enumerate(points):
+                if i != j:
+                    num = num*xj
+                    den = den*(xj - xi)
+            nums.append(num)
+            dens.append(den)
+
+        # Montgomery's trick: invert every denominator with one inversion
+        prefix = [None]*len(dens)
+        acc = group.init(ZR, 1)
+        for i, den in enumerate(dens):
+            prefix[i] = acc
+            acc = acc*den
+        inv = acc.__invert__()
+        coeffs = {}
+        for i in reversed(range(len(dens))):
+            coeffs[key[i]] = nums[i]*prefix[i]*inv
+            inv = inv*dens[i]
+
+        self.lagrange_cache[key] = coeffs
+        if len(self.lagrange_cache) > LAGRANGE_CACHE_SIZE:
+            self.lagrange_cache.popitem(last=False)
+        return coeffs
+
+    def multiexp(self, bases, exps):
+        # Straus: one doubling chain shared by every base, w bits at a time
+        size = 1 << STRAUS_WINDOW
+        tables = []
+        for base in bases:
+            row = [None, base]
+            for _ in range(2, size):
+                row.append(row[-1]*base)
+            tables.append(row)
+
+        scalars = [int(e) for e in exps]
+        bits = max(s.bit_length() for s in scalars)
+        result = None
+        for shift in reversed(range(0, bits, STRAUS_WINDOW)):
+            if result is not None:
+                for _ in range(STRAUS_WINDOW):
+                    result = result*result
+            for row, s in zip(tables, scalars):
+                digit = (s >> shift) & (size-1)
+                if digit:
+                    result = row[digit] if result is None \
+                        else result*row[digit]
+        if result is None:
+            return group.init(G1, 1)
+        return result
+
+    def find_bad_shares(self, pk, shares, message):
+        # batch-check the shares against their verification keys and
+        # bisect any failing group down to the individual culprits
+        minus_one = -group.init(ZR, 1)
+        neg_h = self.hash_message(message) ** minus_one
+        one = group.init(GT, 1)
+
+        def check(group_shares):
+            if len(group_shares) == 1:
+                (idx, data) = group_shares[0]
+                sig_acc, vk_acc = data, pk['g^x_i'][idx-1]
+            else:
+                sig_acc, vk_acc = group.init(G1, 1), group.init(G2, 1)
+                for (idx, data) in group_shares:
+                    r = group.init(ZR, secrets.randbits(BATCH_VERIFY_BITS) | 1)
+                    sig_acc = sig_acc*(data**r)
+                    vk_acc = vk_acc*(pk['g^x_i'][idx-1]**r)
+            return pair([sig_acc, neg_h], [pk['g'], vk_acc]) == one
+
+        bad = []
+        pending = [list(shares)]
+        while pending:
+            group_shares = pending.pop()
+            if not group_shares or check(group_shares):
+                continue
+            if len(group_shares) == 1:
+                bad.append(group_shares[0][0])
+                continue
+            mid = len(group_shares)//2
+            pending.append(group_shares[mid:])
+            pending.append(group_shares[:mid])
+        return bad
+
+    def aggregate(self, shares, method=None):
+        coeffs = self.lagrange_coeffs([idx for (idx, _) in shares])
+        if (method or self.aggregate_method) == "straus":
+            return self.multiexp(
+                [data for (_, data) in shares],
+                [coeffs[idx] for (idx, _) in shares])
 
-    def aggregate(self, shares):
         sign = group.init(G1, 1)
         for (idx, data) in shares:
-            cidx = group.init(ZR, 1)
-            for iidx, _ in shares:
-                if idx != iidx:
-                    gi = (group.init(ZR, iidx) - group.init(ZR, idx))
-                    cidx = cidx*group.init(ZR, iidx) * gi.__invert__()
-            sign = sign*(data**cidx)
+            sign = sign*(data**coeffs[idx])
         return sign
 
 
 if __name__ == "__main__":
     delay = 10
     oneshot = True
-    if len(sys.argv) == 2:
+    if len(sys.argv) >= 2:
         delay = float(sys.argv[1])
         oneshot = False
 
-    groupObj = PairingGroup('MNT224')
+    groupObj = PairingGroup(CURVE)
 
     messages = [b"hello world!!!", b"test message", b"third one"]
 
     bls = BLSTHS(groupObj)
+    if len(sys.argv) == 3:
+        bls.aggregate_method = sys.argv[2]
 
     n, t = 10, 7
     (pk, shares) = bls.keygen(n, t)
@@ -134,3 +335,5 @@ if __name__ == "__main__":
     rate = sig_count/duration
     print(f"Completed {sig_count} in {duration:.2f} seconds")
     print(f"Average is {rate:.2f} signatures per second")
+    stats = bls.hash_stats()
+    print(f"Hash cache: {stats['hits']} hits, {stats['misses']} misses")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+'''
+Runs one initiator and n responders as plain processes on this machine.
+
+Everything talks over loopback: requests go to each responder's own unicast
+port instead of a multicast group, and every responder gets an explicit
+index and key file instead of relying on its container's IP address. With
+--reboots the responders run under restart.py and follow its schedule.
+Output is prefixed with the process name the way docker-compose does it,
+so main.py can read a local run just like a container run.
+
+    ./cluster.py [# nodes] [# threshold] [test duration]
+                 [--reboots attack reboot] [--workers W] [-e NAME=VALUE]
+'''
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_PORT = 6000  # responder i's workers listen from BASE_PORT + i*workers
+GRACE = 5  # seconds responders get to exit on their own after the run
+
+
+def relay(name, proc, quiet):
+    prefix = f"{name:<14}| ".encode()
+    with proc.stdout as out:
+        for line in iter(out.readline, b''):
+            if not quiet:
+                sys.stdout.buffer.write(prefix + line)
+                sys.stdout.flush()
+
+
+def start(name, cmd, env, quiet=False):
+    # a session of its own, so restart.py and its children go down together
+    proc = subprocess.Popen(
+        cmd, cwd=HERE, env=env, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT, start_new_session=True)
+    thread = threading.Thread(target=relay, args=(name, proc, quiet))
+    thread.daemon = True
+    thread.start()
+    return (proc, thread)
+
+
+def stop(procs):
+    deadline = time.time() + GRACE
+    for (proc, _) in procs:
+        try:
+            proc.wait(timeout=max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            pass
+        # the whole group, in case the leader left workers behind
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+    for (_, thread) in procs:
+        thread.join()
+
+
+def run(n, t, runtime, reboots=None, workers=1, extra=None, quiet=False):
+    # returns the initiator's exit code
+    keys = tempfile.mkdtemp(prefix="bls-cluster-")
+    env = dict(
+        os.environ, INITIATOR_HOST="127.0.0.1", FANOUT="unicast",
+        PYTHONUNBUFFERED="1", RESPONDER_WORKERS=str(workers))
+    if reboots is not None:
+        (attack, reboot) = reboots
+        env.update(ATTACK_TIME=str(attack), REBOOT_TIME=str(reboot))
+    env.update(extra or {})
+
+    initiator = start(
+        "initiator", [sys.executable, "server.py", str(n), str(t),
+                      str(runtime)], env)
+    responders = []
+    try:
+        for i in range(n):
+            renv = dict(
+                env, RESPONDER_ID=str(i),
+                KEY_SHARE_PATH=os.path.join(keys, f"share-{i}.key"),
+                UNICAST_PORT=str(BASE_PORT + i*workers))
+            if reboots is None:
+                cmd = [sys.executable, "server.py"]
+            else:
+                renv["NODE_INDEX"] = str(i)
+                cmd = [sys.executable, "restart.py", str(n), str(t),
+                       str(runtime), str(attack), str(reboot)]
+            responders.append(start(f"responder_{i+1}", cmd, renv, quiet))
+        code = initiator[0].wait()
+    finally:
+        stop([initiator] + responders)
+        shutil.rmtree(keys, ignore_errors=True)
+    return code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="run the initiator and n responders on loopback")
+    parser.add_argument("count", type=int)
+    parser.add_argument("threshold", type=int)
+    parser.add_argument("runtime", type=int)
+    parser.add_argument(
+        "--reboots", nargs=2, type=int, metavar=("ATTACK", "REBOOT"),
+        help="run responders under restart.py with these times")
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="signing processes per responder")
+    parser.add_argument(
+        "-e", "--env", action="append", default=[], metavar="NAME=VALUE",
+        help="extra environment for every process, e.g. -e WINDOW=8")
+    parser.add_argument(
+        "--quiet", action="store_true",
+        help="only show the initiator's output")
+    args = parser.parse_args()
+
+    extra = dict(e.split("=", 1) for e in args.env)
+    # clean up after ourselves when killed, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(128+signum))
+    exit(run(
+        args.count, args.threshold, args.runtime, args.reboots,
+        args.workers, extra, args.quiet))
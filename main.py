@@ -1,11 +1,34 @@
 #!/usr/bin/env python3
 
+import dataclasses
+import hashlib
+import json
+import math
+import os
 import sys
 import subprocess
+import time
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 ERROR_LOG = "error.log"
+RESULTS_STORE = "results.jsonl"  # every finished trial, appended as it ends
+# results are only reused while these are unchanged: the container code
+# and what builds and runs it
+CODE_FILES = [
+    "server.py", "bls.py", "restart.py", "wire.py", "netio.py", "stats.py",
+    "Dockerfile", "docker-compose.yml", "cluster.py"]
+# tuning knobs that docker-compose.yml and cluster.py pass to the servers
+CONFIG_ENV = [
+    "CURVE", "WINDOW", "BATCH_SIZE", "VERIFY", "VERIFY_BATCH", "POOL",
+    "POOL_WORKERS", "READY_QUORUM", "KEYGEN_WORKERS", "WATCHDOG_TIMEOUT",
+    "WATCHDOG_MIN", "WATCHDOG_MAX", "PARTIALS_KEPT", "TARGET", "TARGET_SPARE",
+    "RESPONDER_WORKERS", "RESTART_MODE", "IO_BACKEND", "IO_LOOP"]
+# two-sided 95% Student t quantiles by degrees of freedom; in between, the
+# next smaller entry is used, which errs on the wide side
+T_TABLE = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365,
+    8: 2.306, 9: 2.262, 10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042}
 
 
 @dataclass
@@ -21,6 +44,14 @@ class Input:
 class Output:
     signatures: int
     aborts: int
+    # signature latency percentiles in seconds, from the STATS record
+    p50: float = 0
+    p99: float = 0
+    p999: float = 0
+    # trials behind the numbers above, which are their means, and the
+    # half-width of the 95% confidence interval of signatures per second
+    trials: int = 1
+    rate_ci: float = 0
 
 
 @dataclass
@@ -30,8 +61,13 @@ class Record:
     reboots: bool
 
 
-def execute(inp: Input, reboots: bool) -> Record:
+def config_env() -> Dict[str, str]:
+    return {k: os.environ[k] for k in CONFIG_ENV if k in os.environ}
+
+
+def execute(inp: Input, reboots: bool, local: bool = False) -> Record:
     env = {
+        **config_env(),
         "SERVER_COUNT": str(inp.count),
         "THRESHOLD":    str(inp.threshold),
         "RUNTIME":      str(inp.runtime),
@@ -48,40 +84,65 @@ def execute(inp: Input, reboots: bool) -> Record:
         env["REBOOTTIME"] = "disable"
 
     print("running with", env)
-    proc = subprocess.Popen(
-        ["docker-compose", "up"], env=env,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if local:
+        # same run as plain processes on loopback, see cluster.py
+        cmd = [
+            sys.executable, "cluster.py", env["SERVER_COUNT"],
+            env["THRESHOLD"], env["RUNTIME"]]
+        if reboots:
+            cmd += ["--reboots", env["ATTACKTIME"], env["REBOOTTIME"]]
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    else:
+        proc = subprocess.Popen(
+            ["docker-compose", "up"], env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     output = []
+    stats_line = None
     with proc.stdout as out:
         for line in iter(out.readline, b''):
             output.append(line)
-            if b"Completed" in line:
-                sigs_line = line
-            elif b"aborts" in line:
-                aborts_line = line
+            if b"STATS " in line:
+                stats_line = line
     if proc.wait() != 0:
         print("non-zero exit!")
         with open(ERROR_LOG, "wb") as f:
             f.write(b''.join(output))
         print("log dumped to", ERROR_LOG)
-        print("check `docker ps -a` to see if manual cleanup is needed.")
+        if not local:
+            print("check `docker ps -a` to see if manual cleanup is needed.")
         return None
 
-    proc = subprocess.run(
-        ["docker-compose", "down"],
-        env=env,
-        capture_output=True
-    )
-    if proc.returncode != 0:
-        print("Automatic cleanup failed.")
-        print("check `docker ps -a` to see if manual cleanup is needed.")
+    if not local:
+        proc = subprocess.run(
+            ["docker-compose", "down"],
+            env=env,
+            capture_output=True
+        )
+        if proc.returncode != 0:
+            print("Automatic cleanup failed.")
+            print("check `docker ps -a` to see if manual cleanup is needed.")
+            return None
+
+    if stats_line is None:
+        print("no STATS record in the initiator's output!")
+        with open(ERROR_LOG, "wb") as f:
+            f.write(b''.join(output))
+        print("log dumped to", ERROR_LOG)
         return None
 
-    signatures = int(sigs_line.split(b'|')[1].strip().split(b' ')[1])
-    aborts = int(aborts_line.split(b'|')[1].strip().split(b' ')[2])
-    print(f"{signatures} signatures, {aborts} aborts")
-    return Record(inp, Output(signatures, aborts), reboots)
+    # the line is prefixed with the container name by docker-compose
+    run = json.loads(stats_line.split(b"STATS ", 1)[1])
+    latency = run['latency']['sign']
+    output = Output(
+        run['signatures'], run['aborts'], latency.get('p50', 0),
+        latency.get('p99', 0), latency.get('p999', 0))
+    print(f"{output.signatures} signatures, {output.aborts} aborts")
+    print(f"latency p50 {1000*output.p50:0.2f} ms, "
+          f"p99 {1000*output.p99:0.2f} ms, p999 {1000*output.p999:0.2f} ms")
+    print("abort reasons:", run['abort_reasons'])
+    return Record(inp, output, reboots)
 
 
 def stats(rec: Record) -> Tuple[float, float]:
@@ -90,16 +151,123 @@ def stats(rec: Record) -> Tuple[float, float]:
     return success_rate, abort_rate
 
 
+def code_hash() -> str:
+    h = hashlib.sha256()
+    for name in CODE_FILES:
+        with open(name, "rb") as f:
+            h.update(name.encode() + b"\0" + f.read())
+    return h.hexdigest()[:16]
+
+
+def config_key(inp: Input, reboots: bool, local: bool, code: str) -> str:
+    config = {
+        "input": dataclasses.asdict(inp),
+        "reboots": reboots,
+        "local": local,
+        "env": config_env(),
+        "code": code,
+    }
+    encoded = json.dumps(config, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def load_store(filename: str) -> Dict[str, List[Output]]:
+    trials = {}
+    if not os.path.exists(filename):
+        return trials
+    with open(filename, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # cut short by a crash
+            output = Output(**entry["output"])
+            trials.setdefault(entry["key"], []).append(output)
+    return trials
+
+
+def append_store(filename: str, key: str, code: str, rec: Record):
+    entry = {
+        "key": key,
+        "code": code,
+        "input": dataclasses.asdict(rec.input),
+        "reboots": rec.reboots,
+        "output": dataclasses.asdict(rec.output),
+        "time": time.time(),
+    }
+    with open(filename, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def mean(values: List[float]) -> float:
+    return sum(values) / len(values)
+
+
+def confidence(values: List[float]) -> float:
+    # half-width of the 95% confidence interval of the mean
+    n = len(values)
+    if n < 2:
+        return 0
+    m = mean(values)
+    var = sum((v - m)**2 for v in values) / (n - 1)
+    t = T_TABLE[max(df for df in T_TABLE if df <= n - 1)]
+    return t * math.sqrt(var / n)
+
+
+def summarize(inp: Input, reboots: bool, trials: List[Output]) -> Record:
+    sigs = [o.signatures for o in trials]
+    out = Output(
+        round(mean(sigs)), round(mean([o.aborts for o in trials])),
+        mean([o.p50 for o in trials]), mean([o.p99 for o in trials]),
+        mean([o.p999 for o in trials]), len(trials),
+        confidence([s / inp.runtime for s in sigs]))
+    return Record(inp, out, reboots)
+
+
+def run_trials(
+        inp: Input, reboots: bool, local: bool, code: str,
+        store: Dict[str, List[Output]], trials: int) -> Record:
+    # only runs the trials that aren't in the store yet
+    key = config_key(inp, reboots, local, code)
+    done = store.setdefault(key, [])
+    if len(done) >= trials:
+        print(f"have {len(done)} trials of {inp} (reboots {reboots})")
+    for _ in range(trials - len(done)):
+        rec = execute(inp, reboots, local)
+        if rec is None:
+            print("trial failed; it will be run again next time")
+            continue
+        append_store(RESULTS_STORE, key, code, rec)
+        done.append(rec.output)
+    if not done:
+        return None
+    return summarize(inp, reboots, done[:trials])
+
+
+def latency(rec: Record) -> str:
+    out = rec.output
+    return (f"latency p50 {1000*out.p50:0.2f} ms, p99 {1000*out.p99:0.2f} ms,"
+            f" p999 {1000*out.p999:0.2f} ms")
+
+
+def spread(rec: Record) -> str:
+    if rec.output.trials < 2:
+        return ""
+    return f" ± {rec.output.rate_ci:0.2f} ({rec.output.trials} trials)"
+
+
 def save_records(filename: str, records: List[Record]):
     with open(filename, "w") as f:
         f.write("count,threshold,runtime,attack,reboot;")
-        f.write("signatures,aborts;")
+        f.write("signatures,aborts,p50,p99,p999,trials,rate_ci;")
         f.write("reboots\n")
         for rec in records:
             inp = [
                 rec.input.count, rec.input.threshold, rec.input.runtime,
                 rec.input.attack, rec.input.reboot]
-            out = [rec.output.signatures, rec.output.aborts]
+            out = dataclasses.astuple(rec.output)
             r = "yes" if rec.reboots else "no"
             fields = [",".join(map(str, inp)), ",".join(map(str, out)), r]
             f.write(";".join(fields) + "\n")
@@ -112,8 +280,11 @@ def load_records(filename: str) -> List[Record]:
         for line in f:
             inp, out, r = line.split(";")
             inputs = Input(*map(int, inp.split(",")))
-            outputs = Output(*map(int, out.split(",")))
-            reboots = (r == "yes")
+            # older files have fewer columns; the rest keep their defaults
+            outputs = Output(*(
+                field.type(float(value)) for (field, value)
+                in zip(dataclasses.fields(Output), out.split(","))))
+            reboots = (r.strip() == "yes")
             records.append(Record(inputs, outputs, reboots))
     return records
 
@@ -159,10 +330,21 @@ if __name__ == "__main__":
             Input(18, 18, runtime, attack, reboot),
         ]
 
-        # run tests
+        # run whatever isn't in the store for this code and configuration
+        local = "--local" in sys.argv
+        trials = 1
+        if "--trials" in sys.argv:
+            trials = int(sys.argv[sys.argv.index("--trials")+1])
+        code = code_hash()
+        store = load_store(RESULTS_STORE)
         for inp in inputs:
-            records_baseline.append(execute(inp, False))
-            records_reboots.append(execute(inp, True))
+            rb = run_trials(inp, False, local, code, store, trials)
+            rr = run_trials(inp, True, local, code, store, trials)
+            if rb is None or rr is None:
+                print(f"no results for {inp}; leaving it out")
+                continue
+            records_baseline.append(rb)
+            records_reboots.append(rr)
         save_records("records_baseline.csv", records_baseline)
         save_records("records_reboots.csv", records_reboots)
 
@@ -182,10 +364,14 @@ if __name__ == "__main__":
         print(f"count {rb.input.count}, threshold {rb.input.threshold}:")
         print("\t[baseline] ", end="")
         print(f"{rb.output.signatures} signatures, {rb.output.aborts} aborts")
-        print(f"\t--> {b_sigs:0.2f} sigs/sec, {b_aborts*100:0.2f}% failed")
+        print(f"\t--> {b_sigs:0.2f}{spread(rb)} sigs/sec, "
+              f"{b_aborts*100:0.2f}% failed")
+        print(f"\t--> {latency(rb)}")
         print("\t[reboots] ", end="")
         print(f"{rr.output.signatures} signatures, {rr.output.aborts} aborts")
-        print(f"\t--> {r_sigs:0.2f} sigs/sec, {r_aborts*100:0.2f}% failed")
+        print(f"\t--> {r_sigs:0.2f}{spread(rr)} sigs/sec, "
+              f"{r_aborts*100:0.2f}% failed")
+        print(f"\t--> {latency(rr)}")
         print(f"\tReboots are {100*r_sigs/b_sigs:0.1f}% of baseline speed.")
         print()
 
@@ -0,0 +1,100 @@
+'''
+Pluggable datagram I/O for the servers.
+
+The "asyncio" backend is the stock create_datagram_endpoint path, which
+makes one datagram_received call per packet. The "drain" backend watches the
+socket with loop.add_reader and reads every datagram already queued on it
+at each wakeup. It hands the whole burst to the protocol's
+datagrams_received() when the protocol has one. Either backend can run on
+uvloop instead of the default selector loop when IO_LOOP=uvloop and uvloop
+is installed.
+'''
+import asyncio
+import os
+import socket
+
+IO_BACKEND = os.environ.get("IO_BACKEND", "asyncio")  # or "drain"
+IO_LOOP = os.environ.get("IO_LOOP", "asyncio")  # or "uvloop"
+DRAIN_MAX = 256  # datagrams read per wakeup before yielding to the loop
+RECV_SIZE = 65535
+
+
+def new_event_loop(kind=IO_LOOP):
+    if kind == "uvloop":
+        try:
+            import uvloop
+            return uvloop.new_event_loop()
+        except ImportError:
+            print("uvloop is not installed; using the asyncio loop")
+    return asyncio.new_event_loop()
+
+
+class DrainTransport:
+    # just enough of a DatagramTransport for the servers
+    def __init__(self, loop, sock, protocol):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.dropped = 0  # sends that would have blocked
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self.read_ready)
+
+    def read_ready(self):
+        burst = []
+        for _ in range(DRAIN_MAX):
+            try:
+                burst.append(self.sock.recvfrom(RECV_SIZE))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                break  # e.g. an ICMP error queued on the socket
+        if not burst:
+            return
+        if hasattr(self.protocol, "datagrams_received"):
+            self.protocol.datagrams_received(burst)
+        else:
+            for (data, addr) in burst:
+                self.protocol.datagram_received(data, addr)
+
+    def sendto(self, data, addr=None):
+        try:
+            if addr is None:
+                self.sock.send(data)
+            else:
+                self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1  # a full send buffer loses it, like UDP would
+
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self.sock
+        if name == "sockname":
+            return self.sock.getsockname()
+        return default
+
+    def close(self):
+        if self.sock.fileno() < 0:
+            return
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        if hasattr(self.protocol, "connection_lost"):
+            self.protocol.connection_lost(None)
+
+
+async def create_endpoint(
+        loop, protocol_factory, sock=None, local_addr=None,
+        backend=IO_BACKEND):
+    # same arguments and result as loop.create_datagram_endpoint
+    if backend != "drain":
+        return await loop.create_datagram_endpoint(
+            protocol_factory, sock=sock, local_addr=local_addr)
+
+    if sock is None:
+        sock = socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(local_addr)
+    protocol = protocol_factory()
+    transport = DrainTransport(loop, sock, protocol)
+    protocol.connection_made(transport)
+    return (transport, protocol)
@@ -4,9 +4,15 @@ import subprocess
 import sys
 import os
 import signal
+import time
 
 exe = "./server.py"
 OVERLAP = .5
+# "cold" spawns a fresh responder on every reboot, "zygote" keeps a warmed
+# standby waiting and only activates it
+RESTART_MODE = os.environ.get("RESTART_MODE", "cold")
+# seconds to wait for the key share before giving up on the whole run
+KEY_TIMEOUT = float(os.environ.get("KEY_TIMEOUT", 60))
 
 
 def getIP():
@@ -50,56 +56,90 @@ def getCurrNodeIdx(ips, ip):
     return current_node
 
 
+def primeFactors(n):
+    factors = []
+    d = 2
+    while(d*d <= n):
+        if(n % d == 0):
+            factors.append(d)
+            while(n % d == 0):
+                n //= d
+        d += 1
+    if(n > 1):
+        factors.append(n)
+    return factors
+
+
+def findPrimitiveRoot(prime):
+    # smallest g whose powers run through every residue mod prime: g^k
+    # only comes back to 1 at k = prime-1, so no (prime-1)/q power is 1
+    if(prime == 2):
+        return 1
+    factors = primeFactors(prime-1)
+    g = 2
+    while(any(pow(g, (prime-1)//q, prime) == 1 for q in factors)):
+        g += 1
+    return g
+
+
 class RandomNodePicker:
+    # nodes in the order of the powers g^0, g^1, ... mod the next prime
+    # above n, skipping the powers past n; g is a primitive root, so that
+    # visits every node once per round of n picks
     def __init__(self, n):
         self.n = n
         self.prime = findNextPrime(n)
-        self.generators = []
-        for i in range(1, n+1):
-            generatedNums = []
-            generatedNums = self.findGeneratedNums(i, generatedNums)
-            if(len(generatedNums) == n):
-                self.generators.append((i, generatedNums))
-                break
-            self.currGeneratorIdx = 0
-            self.nextGeneratedNumIdx = 0
+        self.generator = findPrimitiveRoot(self.prime)
+        self.power = 1  # the next g^k to consider
+        self.positions = None  # node -> index in a round, once walked
 
     def nextNode(self):
-        nodeNum = self.generators[
-            self.currGeneratorIdx][1][self.nextGeneratedNumIdx]
-        self.nextGeneratedNumIdx += 1
-        if(self.nextGeneratedNumIdx == n):
-            self.nextGeneratedNumIdx = 0
-            self.currGeneratorIdx = (
-                self.currGeneratorIdx + 1) % len(self.generators)
+        # fewer than half of the powers are skipped, since prime < 2n
+        while(self.power > self.n):
+            self.power = (self.power * self.generator) % self.prime
+        nodeNum = self.power - 1
+        self.power = (self.power * self.generator) % self.prime
         return nodeNum
 
-    def findGeneratedNums(self, i, generatedNums):
-        generatedNumsSet = []
-        powersOfiModPrime = 1
-        for x in range(0, self.prime):
-            if(powersOfiModPrime not in generatedNumsSet):
-                generatedNumsSet.append(powersOfiModPrime)
-                if(powersOfiModPrime >= 1 and powersOfiModPrime <= self.n):
-                    generatedNums.append(powersOfiModPrime-1)
-            powersOfiModPrime = (powersOfiModPrime * i) % self.prime
-        return generatedNums
+    def position(self, node):
+        # how many picks come before the node's first one; a single walk
+        # of the cycle answers this for every node
+        if(self.positions is None):
+            self.positions = {}
+            power = 1
+            for _ in range(self.prime - 1):
+                if(power <= self.n):
+                    self.positions[power-1] = len(self.positions)
+                power = (power * self.generator) % self.prime
+        return self.positions[node]
 
 
 class Algorithm:
-    def __init__(self, ips, n, attackTime, rebootTime, t, nodePicker):
-        self.ip = getIP()
+    def __init__(
+            self, ips, n, attackTime, rebootTime, t, nodePicker, node=None):
         self.mIntervals = max(1, attackTime//rebootTime)
-        self.currNodeIdx = getCurrNodeIdx(ips, self.ip)
+        if node is None:
+            self.ip = getIP()
+            node = getCurrNodeIdx(ips, self.ip)
+        self.currNodeIdx = node
         self.t = t
         self.attackTime = attackTime
         self.rebootTime = rebootTime
         self.nodePicker = nodePicker
         self.n = n
         self.numRebootsSoFar = 0
+        self.standby = None
+
+    def spawnStandby(self):
+        # the standby imports charm, builds the group and loads its share,
+        # then blocks on stdin until it is told to take over
+        env = dict(os.environ, STANDBY="1")
+        return subprocess.Popen([exe], env=env, stdin=subprocess.PIPE)
 
     def rebootAfterTime(self, timeToReboot):
-        import time
+        if RESTART_MODE == "zygote":
+            self.rebootAfterTimeZygote(timeToReboot)
+            return
         self.numRebootsSoFar += 1
         print("Going up")
 
@@ -107,7 +147,8 @@ class Algorithm:
         # timetoReboot is the time after which the node is
         # scheduled to be rebooted.
         try:
-            subprocess.run([exe], timeout=timeToReboot+OVERLAP)
+            env = dict(os.environ, LAUNCH_TIME=str(time.time()))
+            subprocess.run([exe], timeout=timeToReboot+OVERLAP, env=env)
             sys.stdout.flush()
             print("received exit signal")
             exit(0)
@@ -116,7 +157,43 @@ class Algorithm:
         finally:
             time.sleep(self.rebootTime-OVERLAP)
 
+    def rebootAfterTimeZygote(self, timeToReboot):
+        self.numRebootsSoFar += 1
+        print("Going up")
+        if self.standby is None:
+            self.standby = self.spawnStandby()
+        active, self.standby = self.standby, None
+        active.stdin.write(b"go\n")
+        active.stdin.flush()
+
+        try:
+            active.wait(timeout=timeToReboot+OVERLAP)
+            sys.stdout.flush()
+            print("received exit signal")
+            exit(0)
+        except subprocess.TimeoutExpired:
+            active.kill()
+            active.wait()
+            print("Went down")
+        # warm the replacement while this node is down
+        self.standby = self.spawnStandby()
+        time.sleep(self.rebootTime-OVERLAP)
+
     def run(self):
+        self.rebootAfterTime(self.nextRebootTime())
+
+    def rebootSlot(self):
+        # the pick at which this node's reboot falls, counted over all
+        # rounds so far; every node is picked once per round of n, so the
+        # first reboot is at the node's position in the round, and each
+        # later one n-1 picks after the previous
+        if(self.numRebootsSoFar == 0):
+            return self.nodePicker.position(self.currNodeIdx)
+        return (self.numRebootsSoFar + 1)*self.n - 1
+
+    def nextRebootTime(self):
+        # how long this node stays up before its next reboot; call it once
+        # per reboot
         if ((self.t) < self.mIntervals):
             subsetSize = self.t
             # print("here")
@@ -124,14 +201,12 @@ class Algorithm:
             logging.debug("node number: " + str(self.currNodeIdx))
             logging.debug("subset size: " + str(subsetSize))
             logging.debug(" mIntervals:" + str(self.mIntervals))
-            N = self.numRebootsSoFar*n
-            while(self.nodePicker.nextNode() != self.currNodeIdx):
-                N += 1
+            N = self.rebootSlot()
             # print("N",N)
             logging.debug("N" + str(N))
             if(self.numRebootsSoFar == 0):
                 N = ((N//subsetSize) * self.mIntervals) + (N % subsetSize)
-                timeToReboot = N * rebootTime
+                timeToReboot = N * self.rebootTime
             else:
                 M = N - self.n
                 N = ((N//subsetSize) * self.mIntervals) + (N % subsetSize)
@@ -141,7 +216,7 @@ class Algorithm:
             logging.debug("timeToReboot: " + str(timeToReboot))
             if(self.numRebootsSoFar > 0):
                 timeToReboot += 10
-            self.rebootAfterTime(timeToReboot)
+            return timeToReboot
 
         else:
             import math
@@ -150,13 +225,11 @@ class Algorithm:
             logging.debug("node number: " + str(self.currNodeIdx))
             logging.debug("subset size: " + str(subsetSize))
             logging.debug("mIntervals: " + str(self.mIntervals))
-            N = self.numRebootsSoFar*n
-            while(self.nodePicker.nextNode() != self.currNodeIdx):
-                N += 1
+            N = self.rebootSlot()
             # print("N",N)
             logging.debug("N" + str(N))
             if(self.numRebootsSoFar == 0):
-                timeToReboot = N//subsetSize * rebootTime
+                timeToReboot = N//subsetSize * self.rebootTime
             else:
                 M = N - self.n
                 M = (M//subsetSize)*subsetSize + subsetSize
@@ -168,48 +241,82 @@ class Algorithm:
             logging.debug("timeToReboot: " + str(timeToReboot))
             if(self.numRebootsSoFar > 0):
                 timeToReboot += 10
-            self.rebootAfterTime(timeToReboot)
+            return timeToReboot
+
 
+def schedule(n, t, attackTime, rebootTime, node, nodePicker=None):
+    # yields the (up, down) times of every period the node runs a
+    # responder, in seconds since its restart loop started; the picker is
+    # deterministic, so anyone can work out any node's schedule, and one
+    # picker can serve the schedules of every node
+    if nodePicker is None:
+        nodePicker = RandomNodePicker(n)
+    algo = Algorithm(
+        None, n, attackTime, rebootTime, t, nodePicker, node)
+    now = 0
+    while True:
+        upFor = algo.nextRebootTime() + OVERLAP
+        algo.numRebootsSoFar += 1
+        yield (now, now + upFor)
+        now += upFor + rebootTime - OVERLAP
 
-# get key first before running main loop
-try:
-    subprocess.run([exe], timeout=1)
-    sys.stdout.flush()
-except subprocess.TimeoutExpired:
+
+def handler(signum, frame):
+    print("Timer ran out")
+    exit(0)
+
+
+def main():
+    # get key first before running main loop; this run exits as soon as
+    # it has the share, so only the real responder announces readiness
+    try:
+        subprocess.run(
+            [exe], env=dict(os.environ, KEY_ONLY="1"), timeout=KEY_TIMEOUT)
+        sys.stdout.flush()
+    except subprocess.TimeoutExpired:
+        print("no key share after", KEY_TIMEOUT, "seconds; giving up")
+        exit(1)
     print("got key")
 
-if "disable" in sys.argv:
-    print("running without reboots")
-    os.execlp(exe, exe)
+    if "disable" in sys.argv:
+        print("running without reboots")
+        os.execlp(exe, exe)
 
-if len(sys.argv) != 1+5:
-    print("Missing arguments:")
-    print("[# nodes] [# threshold] [test duration] [attack t] [reboot t]")
-    exit(1)
+    if len(sys.argv) != 1+5:
+        print("Missing arguments:")
+        print("[# nodes] [# threshold] [test duration] [attack t] [reboot t]")
+        exit(1)
 
-node_count = int(sys.argv[1])
-threshold = int(sys.argv[2])
-total_time = int(sys.argv[3])
-attackTime = int(sys.argv[4])
-rebootTime = int(sys.argv[5])
+    node_count = int(sys.argv[1])
+    threshold = int(sys.argv[2])
+    total_time = int(sys.argv[3])
+    attackTime = int(sys.argv[4])
+    rebootTime = int(sys.argv[5])
 
-ips = []
-for i in range(node_count):
-    ips.append("10.0.0." + str(i+2))
+    ips = []
+    for i in range(node_count):
+        ips.append("10.0.0." + str(i+2))
 
-n = node_count
-nodePicker = RandomNodePicker(n)
-# print(nodePicker.generators)
-logging.debug(nodePicker.generators)
-algo = Algorithm(ips, n, attackTime, rebootTime, threshold, nodePicker)
+    n = node_count
+    nodePicker = RandomNodePicker(n)
+    logging.debug("generator: " + str(nodePicker.generator))
+    # nodes that don't have their own IP, like a local cluster, say which
+    # node they are instead
+    node = os.environ.get("NODE_INDEX")
+    algo = Algorithm(
+        ips, n, attackTime, rebootTime, threshold, nodePicker,
+        None if node is None else int(node))
 
+    # responders report where they are in the schedule, so the initiator
+    # can work out which nodes are up
+    os.environ["NODE_INDEX"] = str(algo.currNodeIdx)
+    os.environ["SCHEDULE_EPOCH"] = repr(time.time())
 
-def handler(signum, frame):
-    print("Timer ran out")
-    exit(0)
+    signal.signal(signal.SIGALRM, handler)
+    signal.alarm(total_time+10)  # 10 extra seconds of leeway
+    while True:
+        algo.run()
 
 
-signal.signal(signal.SIGALRM, handler)
-signal.alarm(total_time+10)  # 10 extra seconds of leeway
-while True:
-    algo.run()
+if __name__ == "__main__":
+    main()
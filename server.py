@@ -4,255 +4,1031 @@ import socket
 import asyncio
 import time
 import os
-from threading import Timer
+import struct
+import signal
+import ctypes
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from bls import BLSTHS, PairingGroup
+from bls import BLSTHS, PairingGroup, CURVE
+import netio
+import restart
+import stats
+import wire
 
 PORT_KEY = 5005   # port for signature share exchange
 PORT_INITIALIZER = 5007  # port that the initializer listens on
-KEY_SHARE_SRC = ("10.0.0.254", PORT_KEY)
-SIG_SHARE_DEST = ("10.0.0.254", PORT_INITIALIZER)
+INITIATOR_HOST = os.environ.get("INITIATOR_HOST", "10.0.0.254")
+KEY_SHARE_SRC = (INITIATOR_HOST, PORT_KEY)
+SIG_SHARE_DEST = (INITIATOR_HOST, PORT_INITIALIZER)
 
 MCAST_CHANNEL = ("224.1.1.1", 5006)  # multicast for signing requests
+# "multicast" sends each request to the group once; "unicast" sends a copy
+# to every responder worker that announced itself, for hosts without
+# multicast routing such as a loopback-only cluster
+FANOUT = os.environ.get("FANOUT", "multicast")
 
-KEY_SHARE_PATH = "./share.key"
+KEY_SHARE_PATH = os.environ.get("KEY_SHARE_PATH", "./share.key")
 
-WATCHDOG_TIMEOUT = .05  # seconds of silence until abort
+# seconds from a request to its t-th share before the session is aborted;
+# this is only the starting value, after which it follows the time it
+# actually takes to collect t shares, like a TCP RTO
+WATCHDOG_TIMEOUT = float(os.environ.get("WATCHDOG_TIMEOUT", .05))
+WATCHDOG_MIN = float(os.environ.get("WATCHDOG_MIN", .02))  # bounds on it
+WATCHDOG_MAX = float(os.environ.get("WATCHDOG_MAX", .5))
+WATCHDOG_GAIN = 1/8  # smoothing of the mean, as in RFC 6298
+WATCHDOG_VAR_GAIN = 1/4  # smoothing of the deviation
+WATCHDOG_VAR_MULT = 4  # deviations of headroom above the mean
+KEY_RETRY = 1  # seconds to wait for a key share before asking again
+READY_INTERVAL = 1  # seconds between readiness announcements
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", 30))  # max wait
+READY_QUORUM = int(os.environ.get("READY_QUORUM", 0))  # 0 means all n
+KEYGEN_WORKERS = int(os.environ.get("KEYGEN_WORKERS", 1))  # share generation
+# share index to ask the key service for; by default it picks a free one
+RESPONDER_ID = os.environ.get("RESPONDER_ID")
+WINDOW = int(os.environ.get("WINDOW", 1))  # signing sessions in flight
+# shares of aborted sessions are kept to seed the next session of the same
+# message, for up to this many messages (0 drops them as before), and late
+# shares still count for the last ABORTED_KEPT aborted sessions
+PARTIALS_KEPT = int(os.environ.get("PARTIALS_KEPT", 64))
+ABORTED_KEPT = 1024
+VERIFY = os.environ.get("VERIFY", "0") == "1"  # check aggregate signatures
+VERIFY_BATCH = int(os.environ.get("VERIFY_BATCH", 1))  # signatures per check
+POOL = os.environ.get("POOL", "none")  # "none", "thread" or "process"
+POOL_WORKERS = int(os.environ.get("POOL_WORKERS", os.cpu_count() or 1))
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 1))  # messages per request
+RESPONDER_WORKERS = int(os.environ.get("RESPONDER_WORKERS", 1))  # processes
+STANDBY = os.environ.get("STANDBY", "0") == "1"  # wait for "go" on stdin
+# fetch the key share and exit without announcing readiness, so a
+# throwaway key-fetch run doesn't count towards the start barrier
+KEY_ONLY = os.environ.get("KEY_ONLY", "0") == "1"
+# responders also listen here for requests addressed only to them; worker w
+# uses the port after it, and 0 picks free ports
+UNICAST_PORT = int(os.environ.get("UNICAST_PORT", 5007))
+# where restart.py has this node in its reboot schedule, if anywhere
+NODE_INDEX = int(os.environ.get("NODE_INDEX", -1))
+SCHEDULE_EPOCH = float(os.environ.get("SCHEDULE_EPOCH", 0))
+# "all" multicasts every request; "schedule" unicasts it to the t + spare
+# responders that should be up and have answered fastest
+TARGET = os.environ.get("TARGET", "all")
+TARGET_SPARE = int(os.environ.get("TARGET_SPARE", 1))
+# restart.py's attack and reboot times; without them (main.py passes
+# "disable" for runs without reboots) only response times and readiness
+# decide who gets requests
+ATTACK_TIME = os.environ.get("ATTACK_TIME", "0")
+ATTACK_TIME = int(ATTACK_TIME) if ATTACK_TIME.isdigit() else 0
+REBOOT_TIME = os.environ.get("REBOOT_TIME", "0")
+REBOOT_TIME = int(REBOOT_TIME) if REBOOT_TIME.isdigit() else 0
+SCHEDULE_MARGIN = .5  # seconds of slack around each scheduled reboot
+
+IDX_FORMAT = "!H"  # responder index in key requests and the key file
+IDX_LEN = struct.calcsize(IDX_FORMAT)
+# readiness: index, worker, workers, unicast port, schedule node and epoch
+READY = struct.Struct("!HHHHhd")
+
+
+def pack_share(idx, curve, raw):
+    # key service replies and the key file are an index, the name of the
+    # curve the keys were made on, and the share
+    name = curve.encode()
+    return struct.pack(IDX_FORMAT, idx) + bytes((len(name),)) + name + raw
+
+
+def parse_share(data):
+    # returns (index, group, share)
+    (idx,) = struct.unpack_from(IDX_FORMAT, data)
+    end = IDX_LEN + 1 + data[IDX_LEN]
+    go = PairingGroup(data[IDX_LEN+1:end].decode())
+    return (idx, go, go.deserialize(data[end:]))
+
+
+def load_share():
+    # returns this responder's (index, group, share); the curve comes with
+    # the share, so responders always sign on the initiator's curve
+    if os.path.isfile(KEY_SHARE_PATH):
+        print("key share exists; loading from file")
+        with open(KEY_SHARE_PATH, "rb") as f:
+            return parse_share(f.read())
+
+    request = b'\xff'
+    if RESPONDER_ID is not None:
+        request += struct.pack(IDX_FORMAT, int(RESPONDER_ID))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(KEY_RETRY)
+    while True:
+        # print("sending share request")
+        sock.sendto(request, KEY_SHARE_SRC)
+        try:
+            (data, _) = sock.recvfrom(1024)
+            break
+        except socket.timeout:
+            print("no key share yet; asking again")
+    (idx, go, share) = parse_share(data)
+    sock.close()
+    # print("got my share:", share)
+    with open(KEY_SHARE_PATH, "wb") as f:
+        f.write(data)
+    print("wrote key share", idx, "on", go.groupType(), "to file")
+    return (idx, go, share)
+
+
+def fork_workers(workers):
+    # every worker joins the multicast group and sees every request, so
+    # the sequence number decides which one signs it; returns this
+    # process's worker number
+    for worker in range(1, workers):
+        if os.fork() == 0:
+            # don't outlive a responder that restart.py kills
+            try:
+                libc = ctypes.CDLL("libc.so.6", use_errno=True)
+                libc.prctl(1, signal.SIGKILL)  # PR_SET_PDEATHSIG
+            except OSError:
+                pass
+            if os.getppid() == 1:
+                os._exit(0)
+            return worker
+    return 0
 
 
 class ResponderServer:
-    def __init__(self, go, bls):
+    def __init__(
+            self, go, bls, idx, share, worker=0, workers=1, launched=None,
+            port=0):
         self.go = go
         self.bls = bls
-
-        if os.path.isfile(KEY_SHARE_PATH):
-            print("key share exists; loading from file")
-            with open(KEY_SHARE_PATH, "rb") as f:
-                self.share = go.deserialize(f.read())
-        else:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.bind(("0.0.0.0", PORT_KEY))
-            # print("sending share request")
-            sock.sendto(b'\xff', KEY_SHARE_SRC)
-            (data, _) = sock.recvfrom(1024)
-            self.share = go.deserialize(data)
-            sock.close()
-            # print("got my share:", self.share)
-            with open(KEY_SHARE_PATH, "wb") as f:
-                f.write(data)
-            print("wrote key share to file")
+        self.idx = idx
+        self.share = share
+        self.worker = worker
+        self.workers = workers
+        self.launched = launched  # when this node was (re)booted
+        self.port = port  # this worker's unicast port
+        self.signing = False
+        self.transport = None
 
     def connection_made(self, transport):
-        self.transport = transport
+        # the multicast and unicast endpoints share this protocol, and
+        # either transport can send the replies
+        if self.transport is None:
+            self.transport = transport
+            self.announce()
+
+    def announce(self):
+        # tell the key service we're loaded, and where to reach this
+        # worker directly, until the first request arrives
+        if self.signing:
+            return
+        ready = b'\xfd' + READY.pack(
+            self.idx, self.worker, self.workers, self.port, NODE_INDEX,
+            SCHEDULE_EPOCH)
+        self.transport.sendto(ready, KEY_SHARE_SRC)
+        loop = asyncio.get_event_loop()
+        loop.call_later(READY_INTERVAL, self.announce)
 
     def datagram_received(self, data, addr):
-        if data == b"\xff":
-            exit(0)
-        idx = data[0]
-        m = data[1:]
-        psign = self.bls.sign(self.share, m)
-        res = idx.to_bytes(1, "big") + self.go.serialize(psign)
+        self.datagrams_received([(data, addr)])
+
+    def datagrams_received(self, burst):
+        # every request in the burst is answered in as few datagrams as fit
+        shares = []
+        for (data, _) in burst:
+            if data == b"\xff":
+                hits, misses = self.bls.hash_hits, self.bls.hash_misses
+                print(f"Hash cache: {hits} hits, {misses} misses")
+                exit(0)
+            for (seq, m) in wire.parse_requests(data):
+                self.signing = True
+                if self.workers > 1 and seq % self.workers != self.worker:
+                    continue  # another worker signs this one
+                psign = self.bls.sign(self.share, m)
+                shares.append((seq, wire.pack_point(self.go, psign)))
         # time.sleep(.1)
-        self.transport.sendto(res, SIG_SHARE_DEST)
+        for res in wire.pack_shares(self.idx, shares):
+            self.transport.sendto(res, SIG_SHARE_DEST)
+        if self.launched is not None and shares:
+            elapsed = time.time() - self.launched
+            print(f"worker {self.worker}: first signature {elapsed:.3f}s "
+                  "after boot")
+            self.launched = None
         # print("sent signature for", idx)
 
 
 class KeyShareServer:
-    def __init__(self, go, all_shares):
+    # hands out key shares and collects readiness for the whole run, so
+    # late or rebuilt responders can still fetch their share
+    def __init__(self, go, all_shares, quorum):
         self.go = go
         self.all_shares = all_shares
-        self.remaining = [n for n in range(len(all_shares))]
+        self.remaining = set(range(len(all_shares)))
+        self.assigned = {}  # host -> index, for requests without an index
+        self.ready = set()
+        self.responders = {}  # index -> what its workers announced
+        self.quorum = quorum
+        self.all_ready = asyncio.Event()
 
     def connection_made(self, transport):
         self.transport = transport
 
-    def datagram_received(self, data, addr):
+    def assign(self, data, addr):
+        if len(data) >= 1+IDX_LEN:
+            (res_idx,) = struct.unpack_from(IDX_FORMAT, data, 1)
+            return res_idx
+        # no index asked for: same host gets the same share back
         (ip, _) = addr
-        res_idx = int(ip.split('.')[-1]) - 2
+        if ip not in self.assigned:
+            if not self.remaining:
+                return None
+            self.assigned[ip] = min(self.remaining)
+        return self.assigned[ip]
 
-        if data == b'\xff':
+    def datagram_received(self, data, addr):
+        if data[:1] == b'\xff':
             # this is a request for a share
+            res_idx = self.assign(data, addr)
+            if res_idx is None or res_idx >= len(self.all_shares):
+                print("no share left for", addr)
+                return
             print("got share request from", res_idx)
-            res = self.go.serialize(self.all_shares[res_idx])
-            self.transport.sendto(res, (ip, PORT_KEY))
-            self.remaining.remove(res_idx)
+            res = pack_share(
+                res_idx, self.go.groupType(),
+                self.go.serialize(self.all_shares[res_idx]))
+            self.transport.sendto(res, addr)
+            self.remaining.discard(res_idx)
             # print("sent share:", self.all_shares[res_idx])
-        if not self.remaining:
-            print("all key shares sent!")
-            loop = asyncio.get_event_loop()
-            loop.stop()
+            if not self.remaining:
+                print("all key shares sent!")
+        elif data[:1] == b'\xfd' and len(data) >= 1+READY.size:
+            # this responder has its share and joined the multicast group
+            (res_idx, worker, workers, port, node, epoch) = \
+                READY.unpack_from(data, 1)
+            info = self.responders.get(res_idx)
+            if info is None or info['workers'] != workers:
+                info = {'ports': {}, 'workers': workers}
+                self.responders[res_idx] = info
+            info['ip'] = addr[0]
+            info['ports'][worker] = port
+            info['node'] = node
+            info['epoch'] = epoch
+            if res_idx not in self.ready:
+                self.ready.add(res_idx)
+                if len(self.ready) >= self.quorum:
+                    self.all_ready.set()
+
+
+class Watchdog:
+    # smoothed estimate of the time from request to the t-th share, with
+    # the timeout set from its mean and deviation (RFC 6298 style)
+    def __init__(
+            self, initial=WATCHDOG_TIMEOUT, low=WATCHDOG_MIN,
+            high=WATCHDOG_MAX):
+        self.low = low
+        self.high = max(low, high)
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.backoffs = 0
+        self.timeout = self.clamp(initial)
+
+    def clamp(self, value):
+        return min(self.high, max(self.low, value))
+
+    def sample(self, elapsed):
+        self.samples += 1
+        if self.srtt is None:
+            self.srtt = elapsed
+            self.rttvar = elapsed/2
+        else:
+            self.rttvar += WATCHDOG_VAR_GAIN*(
+                abs(self.srtt - elapsed) - self.rttvar)
+            self.srtt += WATCHDOG_GAIN*(elapsed - self.srtt)
+        self.timeout = self.clamp(
+            self.srtt + WATCHDOG_VAR_MULT*self.rttvar)
+
+    def backoff(self):
+        # a timed out session says nothing about how long it would have
+        # taken, so it only doubles the timeout (Karn's rule) until the next
+        # sample replaces it
+        self.backoffs += 1
+        self.timeout = self.clamp(2*self.timeout)
+
+    def stats(self):
+        return {
+            'timeout': self.timeout,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'samples': self.samples,
+            'backoffs': self.backoffs,
+        }
+
+
+class Session:
+    # one in-flight signing request and the shares collected for it
+    def __init__(self, seq, m, loop, abort, watchdog):
+        self.seq = seq
+        self.m = m
+        self.signs = []
+        self.seen = set()  # indexes with a share in signs
+        self.extra = []  # (idx, raw share) arriving after the first t
+        self.targets = None  # responders it was unicast to, if any
+        self.loop = loop
+        self.abort = abort
+        self.watchdog = watchdog
+        self.started = loop.time()
+        self.retried = False  # re-collecting after an invalid aggregate
+        self.collected = False  # had t shares at least once
+        self.carried = 0  # shares taken over from aborted sessions
+        self.requested = False  # a request went out, not just seeded
+        self.timer = None
+        self.rearm()
+
+    def rearm(self):
+        # the deadline counts from the request, like the samples, and only
+        # starts over for the multicast fallback or a retry; a pending timer
+        # notices a moved deadline when it fires
+        self.deadline = self.loop.time() + self.watchdog.timeout
+        if self.timer is None:
+            self.timer = self.loop.call_at(self.deadline, self.expire)
+
+    def expire(self):
+        if self.loop.time() < self.deadline:
+            self.timer = self.loop.call_at(self.deadline, self.expire)
+            return
+        self.timer = None
+        self.abort(self.seq)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+def combine(go, bls, pk, batch, verify):
+    # aggregate each (shares, message) in the batch from serialized shares,
+    # then verify the lot; returns whether each signature is good
+    sigs = []
+    for (signs, m) in batch:
+        shares = [(idx, wire.unpack_point(go, raw)) for (idx, raw) in signs]
+        sigs.append((bls.aggregate(shares), m))
+    if not verify or bls.verify_batch(pk, sigs):
+        return [True]*len(sigs)
+    # at least one is bad, so check them one at a time
+    return [bls.verify(pk, sig, m) for (sig, m) in sigs]
+
+
+worker = threading.local()  # per-worker state for the aggregation pool
+
+
+def worker_setup(go, pk):
+    worker.go = go
+    worker.bls = BLSTHS(go)
+    worker.pk = pk
+
+
+def worker_setup_process(curve, pk_raw):
+    # group elements can't be pickled, so the key arrives serialized
+    go = PairingGroup(curve)
+    pk = {k: go.deserialize(v) for (k, v) in pk_raw.items()}
+    pk['identity'] = str(pk['g^x'])
+    worker_setup(go, pk)
+
+
+def worker_combine(batch, verify):
+    return combine(worker.go, worker.bls, worker.pk, batch, verify)
+
+
+def make_pool(kind, workers, go, pk):
+    if kind == "thread":
+        return ThreadPoolExecutor(
+            workers, initializer=worker_setup, initargs=(go, pk))
+    if kind == "process":
+        pk_raw = {k: go.serialize(pk[k]) for k in ('g', 'g^x')}
+        return ProcessPoolExecutor(
+            workers, initializer=worker_setup_process,
+            initargs=(go.groupType(), pk_raw))
+    return None
+
+
+class Targets:
+    # picks the responders that get each request: the ones the reboot
+    # schedule says are up, fastest first by their recent response times
+    def __init__(self, responders, n, t, spare, banned):
+        self.responders = responders  # KeyShareServer.responders, kept live
+        self.n = n
+        self.t = t
+        self.spare = spare
+        self.banned = banned
+        self.response = {}  # index -> smoothed seconds from request to share
+        self.periods = {}  # node -> (schedule, upcoming (up, down) periods)
+        self.targeted = 0  # requests unicast
+        self.fallbacks = 0  # sessions that had to be multicast after all
+
+    def observe(self, res_idx, elapsed):
+        old = self.response.get(res_idx)
+        if old is None:
+            self.response[res_idx] = elapsed
+        else:
+            self.response[res_idx] = old + WATCHDOG_GAIN*(elapsed - old)
+
+    def up(self, info, now):
+        # is the node running, and not about to go down, at this time;
+        # without a node and epoch (e.g. restart.py's first run, which
+        # only fetches the key) there is no schedule to go by
+        if info['node'] < 0 or info['epoch'] <= 0 or \
+                not (ATTACK_TIME and REBOOT_TIME):
+            return True
+        if info['node'] not in self.periods:
+            self.periods[info['node']] = (restart.schedule(
+                self.n, self.t, ATTACK_TIME, REBOOT_TIME, info['node']), [])
+        (schedule, periods) = self.periods[info['node']]
+        at = now - info['epoch']
+        while periods and periods[0][1] < at:
+            periods.pop(0)
+        while not periods or periods[-1][1] < at:
+            periods.append(next(schedule))
+        for (up, down) in periods:
+            if up + SCHEDULE_MARGIN <= at <= down - SCHEDULE_MARGIN:
+                return True
+        return False
+
+    def pick(self):
+        # returns the indexes to unicast to, or None to multicast
+        now = time.time()
+        candidates = [
+            res_idx for (res_idx, info) in self.responders.items()
+            if res_idx+1 not in self.banned and 'ip' in info and
+            len(info['ports']) == info['workers'] and self.up(info, now)]
+        if len(candidates) < self.t:
+            return None
+        # responders with no history yet sort first, so they get measured
+        candidates.sort(key=lambda res_idx: self.response.get(res_idx, 0))
+        return candidates[:self.t+self.spare]
 
 
 class InitiatorServer:
-    def __init__(self, go, bls, all_shares, n, t, pk, ms):
+    def __init__(
+            self, go, bls, all_shares, n, t, pk, ms, window=WINDOW,
+            batch_size=BATCH_SIZE, responders=None):
         self.go = go
+        self.curve = wire.curve_id(go)  # shares on other curves are dropped
         self.bls = bls
         self.all_shares = all_shares
         self.n = n
         self.t = t
         self.pk = pk
         self.ms = ms
-        if len(ms) > 0xff:
-            print("Too many messages! Sequence number will be too long.")
-            exit(1)
+        self.window = max(1, window)
+        self.batch_size = max(1, batch_size)
+        self.requests_sent = 0
+        self.datagrams_sent = 0
+        self.pool = make_pool(POOL, POOL_WORKERS, go, pk)
+        self.jobs = set()  # futures of batches handed to the pool
+        self.loop = asyncio.get_event_loop()
+        self.watchdog = Watchdog()
 
         self.seq = -1
-        self.m = None
-        self.signs = []
+        self.sessions = {}  # seq -> Session
+        self.unverified = []  # sessions with t shares, waiting to aggregate
+        self.settling = {}  # seq -> Session, collected but not yet verified
+        self.banned = set()  # indexes of responders that sent bad shares
+        # latencies from sending a request to having t shares, and to
+        # having a checked signature, plus each responder's response times
+        self.collect_latency = stats.Histogram()
+        self.sign_latency = stats.Histogram()
+        self.response_latency = {}  # index -> Histogram
+        self.abort_reasons = {}  # reason -> count
+        self.partials = OrderedDict()  # message -> {idx: raw share}
+        self.aborted = OrderedDict()  # seq -> message, for late shares
+        self.late = 0  # shares that arrived after their session aborted
+        self.carried = 0  # shares that went on to another session
+        self.rescued = 0  # sessions that reached t with carried shares
+        # seeded sessions signed without sending a request, which are left
+        # out of sig_count and the rate
+        self.unrequested = 0
+        self.responders = {} if responders is None else responders
+        self.targets = None
+        if TARGET == "schedule" and responders is not None:
+            self.targets = Targets(
+                responders, n, t, TARGET_SPARE, self.banned)
+        self.closed = False
         self.sock = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
 
         global sig_count
         global abort_count
+        global invalid_count
         sig_count = 0
         abort_count = 0
+        invalid_count = 0
 
-        self.timer = Timer(WATCHDOG_TIMEOUT, self.abort)
-        self.timer.start()
-
-        self.initiate_new()  # kickstart the whole process
+        self.fill_window()  # kickstart the whole process
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        self.timer.cancel()
-        self.timer = Timer(WATCHDOG_TIMEOUT, self.abort)
-        self.timer.start()
+        self.datagrams_received([(data, addr)])
 
-        (ip, _) = addr
-        res_idx = int(ip.split('.')[-1]) - 2
+    def datagrams_received(self, burst):
+        for (data, _) in burst:
+            if data == b'\xfe':
+                # this is a request to start over
+                for seq in list(self.sessions):
+                    self.abort(seq, "restart")
+                continue
 
-        if data == b'\xfe':
-            # this is a request to start over
-            self.abort()
+            # otherwise these are signature shares!
+            shares = wire.parse_shares(data, self.curve)
+            if shares is None:
+                continue
+            (res_idx, entries) = shares
+            if res_idx+1 in self.banned:
+                continue
+            for (seq, point) in entries:
+                self.receive(seq, res_idx, point)
+        # refill once for the whole burst
+        self.fill_window()
+
+    def receive(self, seq, res_idx, point):
+        session = self.sessions.get(seq)
+        if session is None:
+            session = self.settling.get(seq)
+            if session is not None:
+                # keep it undecoded in case the aggregate turns out invalid
+                session.extra.append((res_idx+1, point))
+                self.record_response(session, res_idx)
+            elif seq in self.aborted:
+                # still a good share of that message
+                self.late += 1
+                self.carry(self.aborted[seq], res_idx+1, point)
+            # else:
+            #     print(f"no session for {seq} from {res_idx}")
+            #     print("discarding extra share")
+            return
+
+        if res_idx+1 in session.seen:
+            return  # answered both a unicast and the multicast fallback
+        # print(f"got signature {seq} from {res_idx}")
+        self.record_response(session, res_idx)
+        self.add_share(session, res_idx+1, point)
+
+    def add_share(self, session, idx, point):
+        session.signs.append((idx, point))
+        session.seen.add(idx)
+        if len(session.signs) < self.t:
             return
+        del self.sessions[session.seq]
+        session.cancel()
+        elapsed = self.loop.time() - session.started
+        if not session.collected:
+            session.collected = True
+            if session.requested:
+                self.collect_latency.record(elapsed)
+            if session.carried:
+                self.rescued += 1
+        if not session.retried and not session.carried:
+            # a retried or seeded session's time says nothing about the
+            # network
+            self.watchdog.sample(elapsed)
+        # whatever is left over for this message isn't needed any more
+        self.partials.pop(session.m, None)
+        self.aggregate_and_verify(session)
+
+    def carry(self, m, idx, point):
+        # a share of an aborted session is as good for any other session
+        # of the same message, so it goes to a live one, or is kept for
+        # the next one
+        if idx in self.banned:
+            return
+        for session in self.sessions.values():
+            if session.m == m and idx not in session.seen:
+                session.carried += 1
+                self.carried += 1
+                self.add_share(session, idx, point)
+                return
+        shares = self.partials.pop(m, {})
+        shares.setdefault(idx, point)
+        self.partials[m] = shares
+        if len(self.partials) > PARTIALS_KEPT:
+            self.partials.popitem(last=False)
+
+    def seed(self, session):
+        # start a new session from the shares kept for its message
+        shares = self.partials.pop(session.m, {})
+        for (idx, point) in shares.items():
+            if session.seq not in self.sessions:
+                break  # already has t
+            if idx not in self.banned:
+                session.carried += 1
+                self.carried += 1
+                self.add_share(session, idx, point)
 
-        # otherwise this is a signature share!
-        seq = data[0]
-        share = self.go.deserialize(data[1:])
-
-        if seq == self.seq:
-            # print(f"got signature {seq} from {res_idx}")
-            self.signs.append((res_idx+1, share))
-            if len(self.signs) >= self.t:
-                self.aggregate_and_verify()
-                self.initiate_new()
-        # else:
-        #     print(f"sequence number mismatch. \
-        #         Expected {self.seq} got {seq} from {res_idx}")
-        #     print("discarding extra share")
-
-    def abort(self):
+    def record_response(self, session, res_idx):
+        if session.retried:
+            return  # timed from the retry, not the request
+        elapsed = self.loop.time() - session.started
+        if res_idx not in self.response_latency:
+            self.response_latency[res_idx] = stats.Histogram()
+        self.response_latency[res_idx].record(elapsed)
+        if self.targets is not None:
+            self.targets.observe(res_idx, elapsed)
+
+    def expired(self, seq):
+        # the watchdog fired; a unicast request gets one more chance with
+        # every responder before the session is given up
+        session = self.sessions.get(seq)
+        if session is None or session.targets is None or self.closed:
+            self.abort(seq, "timeout")
+            return
+        elapsed = self.loop.time() - session.started
+        for res_idx in session.targets:
+            if res_idx+1 not in session.seen:
+                self.targets.observe(res_idx, elapsed)
+        session.targets = None
+        session.retried = True
+        self.targets.fallbacks += 1
+        for msg in wire.pack_requests([(seq, session.m)]):
+            self.send_all(msg)
+        session.rearm()
+
+    def abort(self, seq, reason):
+        session = self.sessions.pop(seq, None)
+        if session is None:
+            return  # already finished
+        session.cancel()
+        print("aborted", seq)
         global abort_count
         abort_count += 1
-        self.initiate_new()
+        self.abort_reasons[reason] = self.abort_reasons.get(reason, 0) + 1
+        if reason == "timeout":
+            self.watchdog.backoff()  # not when a restart aborts them all
+        if PARTIALS_KEPT and not self.closed:
+            self.aborted[seq] = session.m
+            if len(self.aborted) > ABORTED_KEPT:
+                self.aborted.popitem(last=False)
+            for (idx, point) in session.signs:
+                self.carry(session.m, idx, point)
+        self.fill_window()
+
+    def aggregate_and_verify(self, session):
+        self.unverified.append(session)
+        if VERIFY:
+            self.settling[session.seq] = session
+        if not VERIFY or len(self.unverified) >= VERIFY_BATCH:
+            self.verify_pending()
 
-    def aggregate_and_verify(self):
-        self.bls.aggregate(self.signs)
+    def verify_pending(self):
+        batch, self.unverified = self.unverified, []
+        jobs = [(s.signs, s.m) for s in batch]
+        if isinstance(self.pool, ProcessPoolExecutor):
+            # the shares are views into their datagrams, which don't pickle
+            jobs = [
+                ([(idx, bytes(raw)) for (idx, raw) in signs], m)
+                for (signs, m) in jobs]
+        if self.pool is None:
+            try:
+                results = combine(self.go, self.bls, self.pk, jobs, VERIFY)
+            except Exception as e:
+                self.failed(batch, e)
+                return
+            self.settle(batch, results)
+            return
+        job = self.loop.run_in_executor(
+            self.pool, worker_combine, jobs, VERIFY)
+        self.jobs.add(job)
+        job.add_done_callback(lambda done: self.job_done(done, batch))
+
+    def job_done(self, job, batch):
+        self.jobs.discard(job)
+        try:
+            results = job.result()
+        except Exception as e:
+            self.failed(batch, e)
+        else:
+            self.settle(batch, results)
+        self.fill_window()
+
+    def failed(self, batch, error):
+        # aggregation itself raised, e.g. on a share from the network that
+        # charm can't deserialize; the sessions are already out of
+        # self.sessions, so count them as aborted here
+        global abort_count
+        print("aggregation failed:", repr(error))
+        for session in batch:
+            self.settling.pop(session.seq, None)
+            abort_count += 1
+            self.abort_reasons["error"] = \
+                self.abort_reasons.get("error", 0) + 1
+
+    def settle(self, batch, results):
         global sig_count
-        sig_count += 1
-        # print(f"Message: '{self.m}'")
-        # print(f"Signature: {sig}")
-        # if self.bls.verify(self.pk, sig, self.m):
-        #    print("Valid signature!")
-        # else:
-        #    print("INVALID")
-
-    def initiate_new(self):
-        if len(self.signs) < self.t and self.seq != -1:
-            print("aborted", self.seq)
-        self.seq += 1
-        self.seq %= len(self.ms)
-        self.m = self.ms[self.seq]
+        for (session, ok) in zip(batch, results):
+            self.settling.pop(session.seq, None)
+            if not ok:
+                self.recover(session)
+            elif not session.requested:
+                self.unrequested += 1
+            else:
+                sig_count += 1
+                self.sign_latency.record(self.loop.time() - session.started)
+
+    def recover(self, session):
+        # find the responders behind an invalid aggregate, drop them, and
+        # retry with the spare shares that arrived after the first t
+        global invalid_count, abort_count
+        invalid_count += 1
+        print("INVALID signature for", session.seq)
+        raws = session.signs + session.extra
+        session.extra = []
+        shares = [
+            (idx, wire.unpack_point(self.go, raw)) for (idx, raw) in raws]
+        bad = self.bls.find_bad_shares(self.pk, shares, session.m)
+        if not bad:
+            print("no bad share found; giving up on", session.seq)
+            abort_count += 1
+            self.abort_reasons["unrecoverable"] = \
+                self.abort_reasons.get("unrecoverable", 0) + 1
+            return
+        for idx in bad:
+            if idx not in self.banned:
+                print("dropping responder", idx-1)
+                self.banned.add(idx)
+
+        good = {}
+        for (idx, raw) in raws:
+            if idx not in self.banned:
+                good.setdefault(idx, raw)
+        session.signs = list(good.items())
+        session.seen = set(good)
+        if len(session.signs) >= self.t:
+            session.signs = session.signs[:self.t]
+            self.aggregate_and_verify(session)
+        elif not self.closed:
+            # wait for more shares under a fresh watchdog
+            session.retried = True
+            self.sessions[session.seq] = session
+            session.rearm()
+
+    def fill_window(self):
+        # only send full batches, and hold back while the pool already has
+        # two jobs per worker
+        size = min(self.batch_size, self.window)
+        while self.window - len(self.sessions) >= size and not self.closed \
+                and len(self.jobs) < 2*POOL_WORKERS:
+            self.initiate_new(size)
+
+    def initiate_new(self, count=1):
+        requests = []
+        for _ in range(count):
+            self.seq = (self.seq + 1) % wire.SEQ_MOD
+            m = self.ms[self.seq % len(self.ms)]
+            session = Session(
+                self.seq, m, self.loop, self.expired, self.watchdog)
+            self.sessions[self.seq] = session
+            self.seed(session)
+            requests.append((self.seq, m))
+        # carried shares may already have finished some of them
+        requests = [(seq, m) for (seq, m) in requests if seq in self.sessions]
+        for (seq, _) in requests:
+            self.sessions[seq].requested = True
+        self.requests_sent += len(requests)
+        if not requests:
+            return
+
+        targets = None if self.targets is None else self.targets.pick()
+        if targets is not None:
+            self.send_targeted(requests, targets)
+            return
 
         # send requests to all responders
-        self.signs = []
         # time.sleep(.1)
-        msg = self.seq.to_bytes(1, "big") + self.m
-        # print("sending request for", self.seq)
-        self.sock.sendto(msg, MCAST_CHANNEL)
+        # print("sending requests for", [seq for (seq, _) in requests])
+        for msg in wire.pack_requests(requests):
+            self.send_all(msg)
 
+    def send_all(self, msg):
+        if FANOUT != "unicast":
+            self.sock.sendto(msg, MCAST_CHANNEL)
+            self.datagrams_sent += 1
+            return
+        # workers skip sequence numbers that aren't theirs, so every one
+        # can get the same copy
+        for info in list(self.responders.values()):
+            for port in info['ports'].values():
+                self.sock.sendto(msg, (info['ip'], port))
+                self.datagrams_sent += 1
 
-def main():
-    groupObj = PairingGroup('MNT224')
-    bls = BLSTHS(groupObj)
+    def send_targeted(self, requests, targets):
+        # each worker of a responder only signs its own sequence numbers,
+        # so it only gets those
+        for (seq, _) in requests:
+            self.sessions[seq].targets = set(targets)
+        self.targets.targeted += len(requests)
+        for res_idx in targets:
+            info = self.targets.responders[res_idx]
+            for (worker, port) in info['ports'].items():
+                mine = [
+                    (seq, m) for (seq, m) in requests
+                    if seq % info['workers'] == worker]
+                for msg in wire.pack_requests(mine):
+                    self.sock.sendto(msg, (info['ip'], port))
+                    self.datagrams_sent += 1
+
+    def stats(self):
+        # the run's measurements as plain data, for the JSON stats record
+        out = {
+            'latency': {
+                'collect': self.collect_latency.summary(),
+                'sign': self.sign_latency.summary(),
+            },
+            'responders': {
+                str(res_idx): h.summary()
+                for (res_idx, h) in sorted(self.response_latency.items())},
+            'abort_reasons': dict(self.abort_reasons),
+            'watchdog': self.watchdog.stats(),
+            'requests': self.requests_sent,
+            'datagrams': self.datagrams_sent,
+        }
+        if PARTIALS_KEPT:
+            out['partials'] = {
+                'late': self.late,
+                'carried': self.carried,
+                'rescued': self.rescued,
+                'unrequested': self.unrequested,
+            }
+        if self.targets is not None:
+            out['targets'] = {
+                'targeted': self.targets.targeted,
+                'fallbacks': self.targets.fallbacks,
+            }
+        return out
 
+    async def close(self):
+        self.closed = True
+        for session in self.sessions.values():
+            session.cancel()
+        self.sessions.clear()
+        # settle everything that already has its shares
+        while self.unverified or self.jobs:
+            if self.unverified:
+                self.verify_pending()
+            if self.jobs:
+                await asyncio.wait(list(self.jobs))
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+def main():
     messages = [b"hello world!!!", b"test message", b"third one"]
 
     server = None
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
 
     if len(sys.argv) == 1:  # responder
-        sock = socket.socket(
+        (idx, groupObj, share) = load_share()
+        if KEY_ONLY:
+            exit(0)
+        bls = BLSTHS(groupObj)
+        if STANDBY:
+            bls.sign(share, b"warm up")
+            print("standing by")
+            sys.stdout.flush()
+            if not sys.stdin.readline():
+                exit(0)  # restart.py went away
+            launched = time.time()
+        else:
+            launched = float(os.environ.get("LAUNCH_TIME", time.time()))
+        # fork before the event loop exists so workers don't share it
+        worker = fork_workers(RESPONDER_WORKERS)
+        loop = netio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        # requests can be addressed to this worker alone
+        direct = socket.socket(
             socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
-        sock.bind(MCAST_CHANNEL)
-        host = socket.gethostbyname(socket.gethostname())
-        sock.setsockopt(
-            socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
-        sock.setsockopt(
-            socket.SOL_IP, socket.IP_ADD_MEMBERSHIP,
-            socket.inet_aton(MCAST_CHANNEL[0])+socket.inet_aton(host))
-        server = loop.create_datagram_endpoint(
-            lambda: ResponderServer(groupObj, bls), sock=sock)
-
-        loop.run_until_complete(server)
-        print("Starting responder")
+        direct.bind(('0.0.0.0', UNICAST_PORT and UNICAST_PORT + worker))
+        responder = ResponderServer(
+            groupObj, bls, idx, share, worker, RESPONDER_WORKERS, launched,
+            direct.getsockname()[1])
+
+        if FANOUT != "unicast":
+            # or to everyone in the multicast group
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            sock.bind(MCAST_CHANNEL)
+            host = socket.gethostbyname(socket.gethostname())
+            sock.setsockopt(
+                socket.SOL_IP, socket.IP_MULTICAST_IF,
+                socket.inet_aton(host))
+            sock.setsockopt(
+                socket.SOL_IP, socket.IP_ADD_MEMBERSHIP,
+                socket.inet_aton(MCAST_CHANNEL[0])+socket.inet_aton(host))
+            loop.run_until_complete(
+                netio.create_endpoint(loop, lambda: responder, sock=sock))
+        loop.run_until_complete(
+            netio.create_endpoint(loop, lambda: responder, sock=direct))
+        print("Starting responder worker", worker)
         loop.run_forever()
 
     else:  # initiator
+        loop = netio.new_event_loop()
+        asyncio.set_event_loop(loop)
         if len(sys.argv) != 4:
             print("Must specify number, threshold, and test length")
             exit(1)
         n = int(sys.argv[1])
         t = int(sys.argv[2])
         delay = float(sys.argv[3])
+        if CURVE not in wire.CURVES:
+            print(f"unknown curve {CURVE}; use one of "
+                  + ", ".join(wire.CURVES))
+            exit(1)
+        groupObj = PairingGroup(CURVE)
+        bls = BLSTHS(groupObj)
 
-        (pk, shares) = bls.keygen(n, t)
-
-        # share keys first
-        server = loop.create_datagram_endpoint(
-            lambda: KeyShareServer(groupObj, shares),
-            local_addr=('0.0.0.0', PORT_KEY))
-        loop.run_until_complete(server)
-        loop.run_forever()
-        print("done with key distribution")
-        server.close()
+        start = time.time()
+        (pk, shares) = bls.keygen(n, t, workers=KEYGEN_WORKERS)
+        print(f"generated {n} key shares on {CURVE} "
+              f"in {time.time()-start:0.2f} seconds")
 
-        time.sleep(3)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        # share keys first; the key service stays up for the whole run
+        keys = KeyShareServer(groupObj, shares, READY_QUORUM or n)
+        server = netio.create_endpoint(
+            loop, lambda: keys, local_addr=('0.0.0.0', PORT_KEY))
+        (key_transport, _) = loop.run_until_complete(server)
+        try:
+            loop.run_until_complete(
+                asyncio.wait_for(keys.all_ready.wait(), READY_TIMEOUT))
+            print("done with key distribution")
+        except asyncio.TimeoutError:
+            print(f"only {len(keys.ready)} responders ready; starting anyway")
 
-        server = loop.create_datagram_endpoint(
-            lambda: InitiatorServer(groupObj, bls, shares, n, t, pk, messages),
+        server = netio.create_endpoint(
+            loop,
+            lambda: InitiatorServer(
+                groupObj, bls, shares, n, t, pk, messages,
+                responders=keys.responders),
             local_addr=('0.0.0.0', PORT_INITIALIZER))
 
-        loop.run_until_complete(server)
+        (transport, initiator) = loop.run_until_complete(server)
         print("starting initiator")
         try:
             loop.run_until_complete(asyncio.sleep(delay))
         except TimeoutError:
             print("done")
         finally:
-            server.close()
+            loop.run_until_complete(initiator.close())
+            transport.close()
+            key_transport.close()
         global sig_count
         global abort_count
+        global invalid_count
         print(f"Completed {sig_count} in {delay:0.2f} seconds.")
         print(f"Average is {sig_count/delay:0.2f} signatures per second")
-        frac = abort_count/sig_count
+        frac = abort_count/max(1, sig_count)
         print(f"There were {abort_count} aborts ({100*frac:0.5f}%)")
+        if VERIFY:
+            print(f"Found {invalid_count} invalid signatures")
+        sent, datagrams = initiator.requests_sent, initiator.datagrams_sent
+        print(f"Batch size {initiator.batch_size}: sent {sent} requests in "
+              f"{datagrams} datagrams ({sent/max(1, datagrams):0.2f} each)")
+        if initiator.targets is not None:
+            targets = initiator.targets
+            print(f"Targeted {targets.targeted} of {sent} requests; "
+                  f"{targets.fallbacks} fell back to multicast")
+        if PARTIALS_KEPT:
+            print(f"Carried {initiator.carried} shares over from aborted "
+                  f"sessions ({initiator.late} of them late), completing "
+                  f"{initiator.rescued} sessions, {initiator.unrequested} "
+                  f"of them without a request (not counted above)")
+        watchdog = initiator.watchdog.stats()
+        srtt = 1000*(watchdog['srtt'] or 0)
+        print(f"Watchdog timeout {1000*watchdog['timeout']:0.2f} ms "
+              f"(t-th share after {srtt:0.2f} ms on average, "
+              f"{watchdog['samples']} samples, "
+              f"{watchdog['backoffs']} backoffs)")
+        sign = initiator.sign_latency
+        print("Signature latency: " + ", ".join(
+            f"{name} {1000*(sign.percentile(q) or 0):0.2f} ms"
+            for (name, q) in stats.PERCENTILES))
+
+        # one machine-readable line with everything, for main.py
+        record = {
+            'n': n,
+            't': t,
+            'runtime': delay,
+            'signatures': sig_count,
+            'aborts': abort_count,
+            'invalid': invalid_count,
+        }
+        record.update(initiator.stats())
+        print("STATS " + json.dumps(record))
 
         # ask responders to die
-        sock = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
-        sock.sendto(b"\xff", MCAST_CHANNEL)
-        sock.close()
+        initiator.send_all(b"\xff")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+'''
+Offline simulator for restart.py's reboot schedules.
+
+Every node's up and down periods come straight from restart.schedule, so
+they follow the same RandomNodePicker order and Algorithm timing as a live
+run, OVERLAP and the extra 10 seconds after each reboot included. Nodes are
+cut off when restart.py's alarm fires, LEEWAY seconds after the test
+duration. The periods of every configuration are laid on one time grid with
+NumPy, which gives the number of live nodes over time, the fraction of the
+test with fewer than t of them up (no signature can complete then), and an
+upper bound on throughput. Run as
+
+    ./simulate.py [# nodes] [# threshold] [test duration] [attack t]
+                  [reboot t] [--startup S] [--rate R] [--plot]
+    ./simulate.py --sweep [test duration] [--startup S] [--rate R]
+                  [--csv FILE]
+
+--startup is how long a responder takes after boot to sign (see its "first
+signature" log line), and --rate is the signatures per second the cluster
+manages without reboots, e.g. from main.py's baseline runs.
+'''
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import restart
+
+RESOLUTION = .05  # seconds per step of the time grid
+LEEWAY = 10  # restart.py's alarm fires this long after the test duration
+SWEEP_COUNTS = [8, 12, 18]
+SWEEP_ATTACKS = [15, 30, 60, 90, 120]
+SWEEP_REBOOTS = [5, 10, 20, 30]
+
+
+def periods(n, t, attack, reboot, horizon):
+    # (node, up, down) for every period a node runs a responder
+    out = []
+    picker = restart.RandomNodePicker(n)
+    for node in range(n):
+        for (up, down) in restart.schedule(
+                n, t, attack, reboot, node, picker):
+            if up >= horizon:
+                break
+            out.append((node, up, min(down, horizon)))
+    return out
+
+
+def simulate(configs, runtime, startup=0, resolution=RESOLUTION):
+    # configs is a list of (n, t, attack, reboot); returns the live node
+    # count at every step until the alarm, one row per configuration
+    horizon = runtime + LEEWAY
+    steps = int(round(horizon/resolution))
+    rows = []
+    ups = []
+    downs = []
+    for (c, (n, t, attack, reboot)) in enumerate(configs):
+        for (_, up, down) in periods(n, t, attack, reboot, horizon):
+            rows.append(c)
+            ups.append(up + startup)
+            downs.append(down)
+
+    start = np.clip(np.round(np.array(ups)/resolution).astype(int), 0, steps)
+    end = np.clip(np.round(np.array(downs)/resolution).astype(int), 0, steps)
+    rows = np.array(rows, dtype=int)
+    keep = start < end
+    diff = np.zeros((len(configs), steps+1), dtype=np.int32)
+    np.add.at(diff, (rows[keep], start[keep]), 1)
+    np.add.at(diff, (rows[keep], end[keep]), -1)
+    return np.cumsum(diff, axis=1)[:, :steps]
+
+
+def summarize(configs, live, runtime, rate=1, resolution=RESOLUTION):
+    # per configuration: fraction of the test below t, the fewest and mean
+    # live nodes, and the throughput bound at `rate` signatures per second
+    window = live[:, :int(round(runtime/resolution))]
+    t = np.array([config[1] for config in configs])[:, None]
+    below = (window < t).mean(axis=1)
+    return {
+        'below': below,
+        'min': window.min(axis=1),
+        'mean': window.mean(axis=1),
+        'bound': rate*(1 - below),
+    }
+
+
+def timeline(row, resolution=RESOLUTION):
+    # (time, live nodes) at every change
+    changes = np.flatnonzero(np.diff(row)) + 1
+    return [(0, int(row[0]))] + [
+        (i*resolution, int(row[i])) for i in changes]
+
+
+def single(n, t, runtime, attack, reboot, startup, rate, plot=False):
+    config = (n, t, attack, reboot)
+    live = simulate([config], runtime, startup)
+    result = summarize([config], live, runtime, rate or 1)
+
+    print(f"n={n} t={t} attack={attack}s reboot={reboot}s, "
+          f"{runtime}s test ({LEEWAY}s leeway)")
+    for (at, count) in timeline(live[0]):
+        mark = "  < t" if count < t and at < runtime else ""
+        print(f"{at:8.2f}s  {count:3d} up{mark}")
+    print(f"fewer than t up for {100*result['below'][0]:0.2f}% of the test, "
+          f"{result['min'][0]} at least, {result['mean'][0]:0.2f} on average")
+    print(f"throughput bound {result['bound'][0]:0.2f} "
+          + ("of baseline" if rate is None else "signatures/sec"))
+
+    if plot:
+        import matplotlib.pyplot as plt
+        (fig, ax) = plt.subplots()
+        x = np.arange(live.shape[1])*RESOLUTION
+        ax.step(x, live[0], where="post", label="live nodes")
+        ax.axhline(t, color="red", linestyle="--", label="threshold")
+        ax.axvline(runtime, color="gray", linestyle=":", label="test ends")
+        ax.set_xlabel("Seconds")
+        ax.set_ylabel("Responders up")
+        ax.set_title(f"n={n}, t={t}, attack {attack}s, reboot {reboot}s")
+        ax.legend()
+        plt.show()
+
+
+def sweep(runtime, startup, rate, csv=None):
+    configs = [
+        (n, t, attack, reboot)
+        for n in SWEEP_COUNTS for t in range(1, n+1)
+        for attack in SWEEP_ATTACKS for reboot in SWEEP_REBOOTS
+        if reboot <= attack]
+    start = time.time()
+    live = simulate(configs, runtime, startup)
+    result = summarize(configs, live, runtime, rate or 1)
+    elapsed = time.time() - start
+
+    lines = ["count,threshold,attack,reboot,below,min,mean,bound"]
+    for (i, (n, t, attack, reboot)) in enumerate(configs):
+        lines.append(
+            f"{n},{t},{attack},{reboot},{result['below'][i]:0.4f},"
+            f"{result['min'][i]},{result['mean'][i]:0.2f},"
+            f"{result['bound'][i]:0.2f}")
+    if csv is not None:
+        with open(csv, "w") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("\n".join(lines))
+    never = int((result['below'] == 0).sum())
+    print(f"simulated {len(configs)} schedules in {elapsed:0.2f} seconds; "
+          f"{never} never drop below t", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="simulate restart.py reboot schedules")
+    parser.add_argument(
+        "params", type=int, nargs="*",
+        help="[# nodes] [# threshold] [test duration] [attack t] [reboot t],"
+             " or only [test duration] with --sweep")
+    parser.add_argument("--sweep", action="store_true")
+    parser.add_argument(
+        "--startup", type=float, default=0,
+        help="seconds from boot until a responder signs")
+    parser.add_argument(
+        "--rate", type=float,
+        help="signatures/sec without reboots; otherwise bounds are relative")
+    parser.add_argument("--csv", help="write the sweep here")
+    parser.add_argument("--plot", action="store_true")
+    args = parser.parse_args()
+
+    if args.sweep:
+        runtime = args.params[0] if args.params else 120
+        sweep(runtime, args.startup, args.rate, args.csv)
+    elif len(args.params) == 5:
+        single(*args.params, args.startup, args.rate, args.plot)
+    else:
+        parser.print_usage()
+        exit(1)
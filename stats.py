@@ -0,0 +1,84 @@
+'''
+Low-overhead latency histograms for the run statistics.
+
+Values are recorded in microseconds (or another unit, such as nanoseconds
+for microbenchmarks) into log-linear buckets, in the style of HdrHistogram:
+exact below 2**SUB_BITS, and above that every power of two is split into
+2**(SUB_BITS-1) equal buckets. Recording is a couple of integer operations
+and a dict update, and any percentile is within 1% of the truth at the
+default precision.
+'''
+import math
+
+SUB_BITS = 8  # 128 buckets per power of two: under 1% relative error
+UNIT = 1e-6  # recorded values are counted in microseconds by default
+HALF = 1 << (SUB_BITS-1)
+PERCENTILES = [("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9)]
+
+
+def bucket_of(v):
+    if v < 2*HALF:
+        return v
+    shift = v.bit_length() - SUB_BITS
+    return (shift << (SUB_BITS-1)) + (v >> shift)
+
+
+def bucket_range(bucket):
+    # lowest value in the bucket, and how many values it covers
+    if bucket < 2*HALF:
+        return (bucket, 1)
+    shift = (bucket >> (SUB_BITS-1)) - 1
+    return ((bucket - (shift << (SUB_BITS-1))) << shift, 1 << shift)
+
+
+class Histogram:
+    def __init__(self, unit=UNIT):
+        self.unit = unit  # seconds per recorded count
+        # decimals of a second that are meaningful: the unit, and the half
+        # units of bucket midpoints
+        self.digits = max(0, int(round(-math.log10(unit)))) + 1
+        self.counts = {}  # bucket -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        v = max(0, int(seconds/self.unit))
+        b = bucket_of(v)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    def percentile(self, q):
+        # the middle of the bucket holding the q-th percentile, in seconds
+        if not self.count:
+            return None
+        rank = q/100*self.count
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                (low, width) = bucket_range(b)
+                value = min(self.max, max(self.min, low + (width-1)/2))
+                return value*self.unit
+        return self.max*self.unit
+
+    def summary(self):
+        # plain dict for the JSON stats record
+        if not self.count:
+            return {'count': 0}
+        out = {
+            'count': self.count,
+            'mean': self.total/self.count*self.unit,
+            'min': self.min*self.unit,
+            'max': self.max*self.unit,
+        }
+        for (name, q) in PERCENTILES:
+            out[name] = self.percentile(q)
+        # nothing finer than the recording unit is meaningful
+        return {k: round(v, self.digits) for (k, v) in out.items()}
@@ -0,0 +1,196 @@
+'''
+Binary wire format for signing requests and signature shares.
+
+Every datagram starts with a fixed-size header: format version, message
+kind and sequence number. Shares add the responder index and then carry the
+group element as its element type and raw compressed bytes, instead of
+charm's base64 text form. The type byte also names the pairing curve in its
+high bits, so a share made on another curve is dropped instead of misread.
+
+    request: version (1) | kind (1) | seq (4) | message
+    share:   version (1) | kind (1) | seq (4) | idx (2) | type (1) | point
+
+Several requests (or several shares from one responder) can also travel in
+one datagram, each entry with its own sequence number:
+
+    requests: version (1) | kind (1) | count (2) | {seq (4) | len (2) | m}
+    shares:   version (1) | kind (1) | idx (2) | count (2) |
+              {seq (4) | len (1) | type (1) | point}
+
+Batches are split so that no datagram grows past MAX_DATAGRAM. Single-byte
+control messages (0xff, 0xfe) never collide with a header because they are
+shorter than one.
+'''
+import struct
+from binascii import a2b_base64, b2a_base64
+
+VERSION = 2
+REQUEST = 1
+SHARE = 2
+REQUESTS = 3
+SHARES = 4
+
+HEADER = struct.Struct("!BBI")  # version, kind, sequence number
+SHARE_HEADER = struct.Struct("!BBIH")  # ... and responder index
+REQUESTS_HEADER = struct.Struct("!BBH")  # version, kind, count
+REQUEST_ENTRY = struct.Struct("!IH")  # sequence number, message length
+SHARES_HEADER = struct.Struct("!BBHH")  # version, kind, index, count
+SHARE_ENTRY = struct.Struct("!IB")  # sequence number, point length
+SEQ_MOD = 1 << 32
+MAX_DATAGRAM = 1472  # UDP payload that fits a 1500 byte Ethernet frame
+TYPE_BITS = 4  # low bits of a point's type byte; the curve is above them
+# charm's built-in pairing curves, as they are numbered on the wire
+CURVES = {
+    'SS512': 1, 'SS1024': 2, 'MNT159': 3, 'MNT201': 4, 'MNT224': 5,
+    'BN254': 6}
+
+
+def pack_request(seq, m):
+    return HEADER.pack(VERSION, REQUEST, seq) + m
+
+
+def parse_request(data):
+    # returns (seq, message), or None for anything that isn't a request
+    if len(data) < HEADER.size:
+        return None
+    (version, kind, seq) = HEADER.unpack_from(data)
+    if version != VERSION or kind != REQUEST:
+        return None
+    return (seq, data[HEADER.size:])
+
+
+def curve_id(go):
+    curve = go.groupType()
+    if curve not in CURVES:
+        raise ValueError("no wire number for curve %r" % curve)
+    return CURVES[curve]
+
+
+def pack_point(go, elem):
+    # charm only serializes to "<type>:<base64>", so strip that back down
+    (kind, _, text) = go.serialize(elem).partition(b':')
+    return bytes((curve_id(go) << TYPE_BITS | int(kind),)) + \
+        a2b_base64(text)
+
+
+def unpack_point(go, buf):
+    kind = buf[0] & ((1 << TYPE_BITS) - 1)
+    return go.deserialize(
+        b'%d:' % kind + b2a_base64(buf[1:], newline=False))
+
+
+def point_curve(point):
+    return point[0] >> TYPE_BITS if len(point) else 0
+
+
+def pack_share(seq, idx, point):
+    return SHARE_HEADER.pack(VERSION, SHARE, seq, idx) + point
+
+
+def parse_share(data):
+    # returns (seq, idx, point) with the point as a view into data, or None
+    if len(data) <= SHARE_HEADER.size:
+        return None
+    (version, kind, seq, idx) = SHARE_HEADER.unpack_from(data)
+    if version != VERSION or kind != SHARE:
+        return None
+    return (seq, idx, memoryview(data)[SHARE_HEADER.size:])
+
+
+def split(entries, header_size):
+    # group encoded entries so each datagram stays under MAX_DATAGRAM
+    groups = []
+    group = []
+    size = header_size
+    for entry in entries:
+        if group and size + len(entry) > MAX_DATAGRAM:
+            groups.append(group)
+            group = []
+            size = header_size
+        group.append(entry)
+        size += len(entry)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def pack_requests(requests):
+    # requests is a list of (seq, message); returns the datagrams to send
+    if len(requests) == 1:
+        return [pack_request(*requests[0])]
+    entries = [REQUEST_ENTRY.pack(seq, len(m)) + m for (seq, m) in requests]
+    return [
+        REQUESTS_HEADER.pack(VERSION, REQUESTS, len(group)) + b''.join(group)
+        for group in split(entries, REQUESTS_HEADER.size)]
+
+
+def parse_requests(data):
+    # returns a list of (seq, message), empty for anything else
+    if len(data) < REQUESTS_HEADER.size or data[0] != VERSION:
+        return []
+    if data[1] == REQUEST:
+        request = parse_request(data)
+        return [] if request is None else [request]
+    if data[1] != REQUESTS:
+        return []
+    (_, _, count) = REQUESTS_HEADER.unpack_from(data)
+    requests = []
+    offset = REQUESTS_HEADER.size
+    for _ in range(count):
+        # a truncated batch is dropped whole, like any other bad datagram
+        if offset + REQUEST_ENTRY.size > len(data):
+            return []
+        (seq, length) = REQUEST_ENTRY.unpack_from(data, offset)
+        offset += REQUEST_ENTRY.size
+        if offset + length > len(data):
+            return []
+        requests.append((seq, data[offset:offset+length]))
+        offset += length
+    return requests
+
+
+def pack_shares(idx, shares):
+    # shares is a list of (seq, point); returns the datagrams to send
+    if len(shares) == 1:
+        return [pack_share(shares[0][0], idx, shares[0][1])]
+    entries = [
+        SHARE_ENTRY.pack(seq, len(point)) + point for (seq, point) in shares]
+    return [
+        SHARES_HEADER.pack(VERSION, SHARES, idx, len(group)) + b''.join(group)
+        for group in split(entries, SHARES_HEADER.size)]
+
+
+def parse_shares(data, curve=None):
+    # returns (idx, [(seq, point), ...]) with the points as views into
+    # data, or None for anything that isn't a share; with a curve number,
+    # points on any other curve are left out
+    if len(data) <= SHARES_HEADER.size or data[0] != VERSION:
+        return None
+    if data[1] == SHARE:
+        share = parse_share(data)
+        if share is None:
+            return None
+        (seq, idx, point) = share
+        shares = [(seq, point)]
+    elif data[1] != SHARES:
+        return None
+    else:
+        (_, _, idx, count) = SHARES_HEADER.unpack_from(data)
+        view = memoryview(data)
+        shares = []
+        offset = SHARES_HEADER.size
+        for _ in range(count):
+            # a truncated batch is dropped whole, like any other bad one
+            if offset + SHARE_ENTRY.size > len(data):
+                return None
+            (seq, length) = SHARE_ENTRY.unpack_from(data, offset)
+            offset += SHARE_ENTRY.size
+            if offset + length > len(data):
+                return None
+            shares.append((seq, view[offset:offset+length]))
+            offset += length
+    if curve is not None:
+        shares = [
+            (seq, point) for (seq, point) in shares
+            if point_curve(point) == curve]
+    return (idx, shares)